@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import json, time, zlib
+
+COMPRESSION_HEADER = 'x-bsl-compression'
+
+
+class Codec(object):
+    """Codec is the base class of the message body formats.
+
+    Derived classes set name and content_type and implement encode/decode.
+    """
+    name = None
+    content_type = None
+
+    def encode(self, payload):
+        """
+        :param payload: the object to send
+        :return: the message body as a byte string
+        """
+        raise NotImplementedError("Please implement the Class")
+
+    def decode(self, body):
+        """
+        :param body: the message body as a byte string
+        :return: the object sent
+        """
+        raise NotImplementedError("Please implement the Class")
+
+
+class JsonCodec(Codec):
+    name = 'json'
+    content_type = 'application/json'
+
+    def encode(self, payload):
+        return json.dumps(payload, separators=(',', ':'))
+
+    def decode(self, body):
+        return json.loads(body)
+
+
+class RawCodec(Codec):
+    """Pass byte strings through as they are, without copying them."""
+    name = 'raw'
+    content_type = 'application/data'
+
+    def encode(self, payload):
+        if not isinstance(payload, (str, bytearray, buffer)):
+            raise TypeError("raw payloads must be byte strings, not %s" % type(payload).__name__)
+        return payload
+
+    def decode(self, body):
+        return body
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+
+    def __init__(self, msgpack):
+        self.msgpack = msgpack
+
+    def encode(self, payload):
+        return self.msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, body):
+        return self.msgpack.unpackb(body, raw=False)
+
+
+class Compressor(object):
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+class Registry(object):
+    """Codecs by name and content type, compressors by name, and the time
+    spent in each of them.
+
+    encode() compresses the body when compression is given and the body is
+    at least threshold bytes long, and names the compressor in the
+    x-bsl-compression header so that decode() can undo it.
+    """
+
+    def __init__(self):
+        self.codecs = {}
+        self.content_types = {}
+        self.compressors = {}
+        self.timings = {}
+
+    def register(self, codec):
+        self.codecs[codec.name] = codec
+        self.content_types[codec.content_type] = codec
+
+    def register_compressor(self, compressor):
+        self.compressors[compressor.name] = compressor
+
+    def get(self, name):
+        try:
+            return self.codecs[name]
+        except KeyError:
+            raise LookupError("Unknown codec: %s" % name)
+
+    def knows(self, content_type, headers=None):
+        """Whether decode() handles such a message without an explicit codec."""
+        return content_type in self.content_types or bool(headers and COMPRESSION_HEADER in headers)
+
+    def encode(self, payload, codec='json', compression=None, threshold=0):
+        """
+        :return: (body, content_type, headers)
+        """
+        codec = self.get(codec)
+        start = time.time()
+        body = codec.encode(payload)
+        self._time(codec.name, 'encode', start)
+        headers = {}
+        if compression and len(body) >= threshold:
+            try:
+                compressor = self.compressors[compression]
+            except KeyError:
+                raise LookupError("Unknown compression: %s" % compression)
+            start = time.time()
+            body = compressor.compress(body)
+            self._time(compression, 'encode', start)
+            headers[COMPRESSION_HEADER] = compression
+        return body, codec.content_type, headers
+
+    def decode(self, body, content_type=None, headers=None, codec=None):
+        """
+        :param codec: the codec name, by default the one of content_type
+        """
+        compression = headers.get(COMPRESSION_HEADER) if headers else None
+        if compression:
+            try:
+                compressor = self.compressors[compression]
+            except KeyError:
+                raise LookupError("Unknown compression: %s" % compression)
+            start = time.time()
+            body = compressor.decompress(body)
+            self._time(compression, 'decode', start)
+        if codec is not None:
+            codec = self.get(codec)
+        else:
+            codec = self.content_types.get(content_type) or self.codecs['raw']
+        start = time.time()
+        payload = codec.decode(body)
+        self._time(codec.name, 'decode', start)
+        return payload
+
+    def _time(self, name, op, start):
+        key = (name, op)
+        timing = self.timings.get(key)
+        if timing is None:
+            timing = self.timings[key] = [0, 0.0]
+        timing[0] += 1
+        timing[1] += time.time() - start
+
+    def stats(self):
+        """
+        :return: {name: {'encode': (count, seconds), 'decode': (count, seconds)}}
+        """
+        stats = {}
+        for (name, op), (count, seconds) in self.timings.items():
+            stats.setdefault(name, {})[op] = (count, seconds)
+        return stats
+
+
+REGISTRY = Registry()
+REGISTRY.register(JsonCodec())
+REGISTRY.register(RawCodec())
+REGISTRY.register_compressor(Compressor('zlib', zlib.compress, zlib.decompress))
+try:
+    import msgpack
+    REGISTRY.register(MsgpackCodec(msgpack))
+except ImportError:
+    pass
+try:
+    import lz4.frame
+    REGISTRY.register_compressor(Compressor('lz4', lz4.frame.compress, lz4.frame.decompress))
+except ImportError:
+    pass
+
+register = REGISTRY.register
+register_compressor = REGISTRY.register_compressor
+encode = REGISTRY.encode
+decode = REGISTRY.decode
+stats = REGISTRY.stats
@@ -1,13 +1,18 @@
 #-*- encoding: utf8 -*-
-import ConfigParser
+import ConfigParser, os, re, StringIO, threading, time
+try:
+    import eventlet
+except ImportError:
+    eventlet = None
 class Opt(object):
     """Opt is a Abstract Base Class which is used to wrap the options in configuration file.
 
     """
-    def __init__(self, key, group='default', default=None):
+    def __init__(self, key, group='default', default=None, choices=None):
         self.group = group
         self.key = key
         self.default = default
+        self.choices = choices
     def parse(self, value):
         """ The method is a abstract method which should be overrided in derived class.
 
@@ -15,6 +20,26 @@ class Opt(object):
         :return: The value after being parsed.
         """
         raise NotImplementedError("Please implement the Class")
+    def validate(self, value):
+        """ The method is used to check the parsed value, it is invoked when the snapshot is compiled.
+
+        :param value: The value returned by parse.
+        :return: The value if it is valid, otherwise ValueError is raised.
+        """
+        if self.choices is not None and value not in self.choices:
+            raise ValueError("%s.%s must be one of %s, not %r" % (self.group, self.key, self.choices, value))
+        return value
+
+class RangeMixin(object):
+    """ The class is used to check the parsed number is in [min, max].
+
+    """
+    min = None
+    max = None
+    def validate(self, value):
+        if self.min is not None and value < self.min or self.max is not None and value > self.max:
+            raise ValueError("%s.%s must be in [%s, %s], not %r" % (self.group, self.key, self.min, self.max, value))
+        return super(RangeMixin, self).validate(value)
 
 
 class BoolOpt(Opt):
@@ -40,8 +65,8 @@ class StrOpt(Opt):
     """ The class is used to parse value to String.
 
     """
-    def __init__(self, key, group='default', default=''):
-        super(StrOpt, self).__init__(key, group, default)
+    def __init__(self, key, group='default', default='', choices=None):
+        super(StrOpt, self).__init__(key, group, default, choices)
     def parse(self, value):
         if value is None:
             return ''
@@ -50,24 +75,28 @@ class StrOpt(Opt):
         except Exception as e:
             return str(self.default)
 
-class IntOpt(Opt):
+class IntOpt(RangeMixin, Opt):
     """ The class is used to parse value to Int.
 
     """
-    def __init__(self, key, group='default', default=0):
+    def __init__(self, key, group='default', default=0, min=None, max=None):
         super(IntOpt, self).__init__(key, group, default)
+        self.min = min
+        self.max = max
     def parse(self, value):
         try:
             return int(value)
         except Exception as e:
             return int(self.default)
 
-class FloatOpt(Opt):
+class FloatOpt(RangeMixin, Opt):
     """ The class is used to parse value to Float.
 
     """
-    def __init__(self, key, group='default', default=0):
+    def __init__(self, key, group='default', default=0, min=None, max=None):
         super(FloatOpt, self).__init__(key, group, default)
+        self.min = min
+        self.max = max
     def parse(self, value):
         try:
             return float(value)
@@ -125,6 +154,71 @@ class DictOpt(Opt):
         else:
             return dict()
 
+class GroupSnapshot(object):
+    """ The base class of the frozen groups of a ConfigSnapshot.
+
+        freeze() derives one class per group whose __slots__ are the keys of the group, so reading a
+        value is a plain attribute load. Keys which are not identifiers have their other characters
+        replaced by '_'. The instances are immutable.
+    """
+    __slots__ = ()
+    def __init__(self, values):
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+    def __setattr__(self, key, value):
+        raise AttributeError("The snapshot is immutable")
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+    def __contains__(self, key):
+        return hasattr(self, key)
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__ if hasattr(self, key))
+
+class ConfigSnapshot(object):
+    """ The immutable view of all groups returned by ConfigOpts.snapshot().
+
+    """
+    def __init__(self, groups):
+        self.__dict__.update(groups)
+    def __setattr__(self, key, value):
+        raise AttributeError("The snapshot is immutable")
+    def __getitem__(self, group):
+        try:
+            return self.__dict__[group]
+        except KeyError:
+            raise KeyError(group)
+    def __contains__(self, group):
+        return group in self.__dict__
+    def __iter__(self):
+        return iter(self.__dict__)
+    def as_dict(self):
+        return dict((group, values.as_dict()) for group, values in self.__dict__.items())
+
+def _set(fp, origin, group, key, value, source):
+    if not fp.has_section(group):
+        # add_section() refuses a section named 'default', the parser itself does not.
+        fp.readfp(StringIO.StringIO('[%s]\n' % group))
+    fp.set(group, key, value)
+    origin[(group, key)] = source
+
+def _identifier(key):
+    key = re.sub(r'\W', '_', key)
+    return '_' + key if key[:1].isdigit() else key
+
+class _State(object):
+    """ The merged sources, their cache and snapshot, swapped as one object by ConfigOpts.reload().
+
+    """
+    __slots__ = ('fp', 'cache', 'snapshot', 'origin')
+    def __init__(self, fp=None, cache=None, snapshot=None, origin=None):
+        self.fp = fp
+        self.cache = dict() if cache is None else cache
+        self.snapshot = snapshot
+        self.origin = dict() if origin is None else origin
+
 class ConfigOpts(object):
     """ The class used to parse the configuration file which is based on python standard module ConfigParser.
 
@@ -132,38 +226,128 @@ class ConfigOpts(object):
         configuration file and parse the value to some known type such as dict, list  via register_opts/
         register_opt. The unregister_opt is used to eliminate the options(registered by register_opts/
         register_opt) in the cache.
+
+        freeze()/snapshot() compile the file and the registered options into an immutable ConfigSnapshot
+        whose values are parsed and validated once, e.g. CONF.snapshot().rabbitmq.pool_size.
+
+        reload() re-reads the file and swaps the parser, the cache and the snapshot in one assignment, so
+        a reader sees either the old or the new configuration. The callbacks registered by subscribe() are
+        then invoked for every changed key. ConfigWatcher calls reload() when the file changes.
+
+        The configuration is merged from several sources, a later one overriding an earlier one: the files
+        and conf.d directories given to setup() in order, the environment variables <env_prefix>_<GROUP>_<KEY>
+        and the values of set_override(). They are merged once per (re)load into a single parser, so lookups
+        never consult the sources, and origin() tells which source a value came from. The environment
+        variables of a group first registered after the load are merged on its registration.
     """
-    def __init__(self):
-        self.__cache = dict()
-        self.fp = None
+    def __init__(self, env_prefix='BSL'):
+        self.__state = _State()
+        self.__opts = dict()
+        self.__subscribers = list()
+        self.__overrides = dict()
+        self.env_prefix = env_prefix
         self.path = None
+    @property
+    def fp(self):
+        return self.__state.fp
     def setup(self, path):
+        """ The method is used to load the configuration.
+
+        :param path: a file or a conf.d directory, whose *.conf files are read in name order, or a list
+                     of them
+        """
         self.path = path
-        self.fp = None
         self._reload()
+    def files(self):
+        """ The method is used to get the configuration files, in the order they are merged.
+
+        """
+        paths = [self.path] if isinstance(self.path, basestring) else list(self.path or ())
+        files = list()
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.conf')))
+            else:
+                files.append(path)
+        return files
+    def _read(self):
+        fp = ConfigParser.ConfigParser()
+        origin = dict()
+        for path in self.files():
+            layer = ConfigParser.ConfigParser()
+            if not layer.read(path):
+                continue
+            for group in layer.sections():
+                for key, value in layer.items(group, raw=True):
+                    _set(fp, origin, group, key, value, path)
+        for group, key, value, source in self._env(set(fp.sections()) | set(self.__opts)):
+            _set(fp, origin, group, key, value, source)
+        for (group, key), value in self.__overrides.items():
+            _set(fp, origin, group, key, value, 'override')
+        return fp, origin
+    def _env(self, groups):
+        """ The method is used to map the environment variables <env_prefix>_<GROUP>_<KEY> to groups.
+
+        :return: a list of (group, key, value, source)
+        """
+        if not self.env_prefix:
+            return []
+        prefix = self.env_prefix.upper() + '_'
+        groups = sorted(groups, key=len, reverse=True)
+        values = list()
+        for name, value in os.environ.items():
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            for group in groups:
+                # The longest group wins, e.g. BSL_A_B_C is group a_b and key c if a_b exists.
+                if rest.lower().startswith(group.lower() + '_'):
+                    values.append((group, rest[len(group) + 1:].lower(), value, 'env:' + name))
+                    break
+        return values
+    def _merge_env(self, group, state):
+        """ The method is used to merge the environment variables of a group registered after the load,
+        which _read() could not tell from the other ones. The overrides still win.
+
+        """
+        for g, key, value, source in self._env(set(state.fp.sections()) | set(self.__opts)):
+            if g != group or state.origin.get((g, key)) == 'override':
+                continue
+            _set(state.fp, state.origin, g, key, value, source)
+            state.cache.pop(g, None)
     def _reload(self):
-        if self.fp:
-            self.fp = None
-        self.fp = ConfigParser.ConfigParser()
-        self.fp.read(self.path)
-    def _reload_group(self, group):
-        self.__cache[group] = dict()
-        ops = self.fp.options(group)
-        for op in ops:
-            self.__cache[group][op] = self.fp.get(group, op)
+        fp, origin = self._read()
+        self.__state = _State(fp, origin=origin)
+    def _reload_group(self, group, state=None):
+        state = state or self.__state
+        values = dict((op, state.fp.get(group, op)) for op in state.fp.options(group))
+        for key, opt in self.__opts.get(group, dict()).items():
+            values[key] = opt.parse(values[key] if key in values else opt.default)
+        state.cache[group] = values
+    def _load(self, fp):
+        """ The method is used to get every value of fp, the registered options being parsed.
+
+        """
+        values = dict()
+        for group in fp.sections():
+            values[group] = dict((op, fp.get(group, op)) for op in fp.options(group))
+            for key, opt in self.__opts.get(group, dict()).items():
+                values[group][key] = opt.parse(fp.get(group, key) if fp.has_option(group, key) else opt.default)
+        return values
     def __getitem__(self, group='default'):
-        if not self.fp:
+        state = self.__state
+        if not state.fp:
             raise Exception("Please invoke method setup first!")
-        if self.fp.has_section(group):
-            if group not in self.__cache:
-                self._reload_group(group)
-            return self.__cache[group]
+        if state.fp.has_section(group):
+            if group not in state.cache:
+                self._reload_group(group, state)
+            return state.cache[group]
         else:
             return None
     def __iter__(self):
-        return self.__cache.__iter__()
+        return self.__state.cache.__iter__()
     def __len__(self):
-        return len(self.__cache)
+        return len(self.__state.cache)
     def __getattr__(self, group='default'):
         return self.__getitem__(group)
     def register_opts(self, opts):
@@ -177,15 +361,25 @@ class ConfigOpts(object):
     def register_opt(self, opt):
         if not isinstance(opt, Opt):
             raise TypeError("Options type ERROR")
-        if opt.group not in self.__cache:
-            if self.fp.has_section(opt.group):
-                self._reload_group(opt.group)
+        registered = self.__opts.get(opt.group, dict()).get(opt.key)
+        if registered is opt or (type(registered) is type(opt) and registered.__dict__ == opt.__dict__):
+            # Already in the cache and the snapshot, e.g. rabbit_opts for every new Connection.
+            return
+        state = self.__state
+        new = opt.group not in self.__opts
+        self.__opts.setdefault(opt.group, dict())[opt.key] = opt
+        state.snapshot = None
+        if new and state.fp:
+            self._merge_env(opt.group, state)
+        if opt.group not in state.cache:
+            if state.fp.has_section(opt.group):
+                self._reload_group(opt.group, state)
             else:
                 return
-        if not self.fp.has_option(opt.group, opt.key):
-            self.__cache[opt.group][opt.key] = opt.parse(opt.default)
+        if not state.fp.has_option(opt.group, opt.key):
+            state.cache[opt.group][opt.key] = opt.parse(opt.default)
         else:
-            self.__cache[opt.group][opt.key] = opt.parse(self.fp.get(opt.group, opt.key))
+            state.cache[opt.group][opt.key] = opt.parse(state.fp.get(opt.group, opt.key))
     def unregister_opt(self, key, group='default'):
         """ The method is used to unregister the options
 
@@ -193,14 +387,18 @@ class ConfigOpts(object):
         :param group: section in configuration file, default is 'default'
         :return: True: execute successfully; False: execute failure
         """
-        if group not in self.__cache:
+        state = self.__state
+        if key in self.__opts.get(group, ()):
+            del self.__opts[group][key]
+            state.snapshot = None
+        if group not in state.cache:
             return True
-        if key not in self.__cache[group]:
+        if key not in state.cache[group]:
             return True
         try:
-            del self.__cache[group][key]
-            if not self.__cache[group]:
-                del self.__cache[group]
+            del state.cache[group][key]
+            if not state.cache[group]:
+                del state.cache[group]
         except Exception as e:
             return False
         return True
@@ -212,19 +410,187 @@ class ConfigOpts(object):
         :param default: default value corresponding to the key given by client
         :return: the corresponding value of the key.
         """
-        if not self.fp:
+        state = self.__state
+        if not state.fp:
             raise Exception("Please invoke method setup first!")
-        if group not in self.__cache:
-            self._reload_group(group)
+        cache = state.cache
+        if group not in cache:
+            self._reload_group(group, state)
         try:
-            return self.__cache[group][key]
+            return cache[group][key]
         except KeyError as e:
-            if self.fp.has_option(group, key):
-                self.__cache[group][key] = self.fp.get(group, key)
+            if state.fp.has_option(group, key):
+                cache[group][key] = state.fp.get(group, key)
             else:
-                self.__cache[group][key] = default
-        return self.__cache[group][key]
+                cache[group][key] = default
+        return cache[group][key]
+    def _compile(self, fp):
+        groups = dict()
+        for group in set(fp.sections()) | set(self.__opts):
+            values = dict()
+            if fp.has_section(group):
+                for key in fp.options(group):
+                    values[key] = fp.get(group, key)
+            for key, opt in self.__opts.get(group, dict()).items():
+                raw = fp.get(group, key) if fp.has_option(group, key) else opt.default
+                values[key] = opt.validate(opt.parse(raw))
+            values = dict((_identifier(key), value) for key, value in values.items())
+            cls = type(str('%sSnapshot' % _identifier(group).title()), (GroupSnapshot,), {'__slots__': tuple(values)})
+            groups[group] = cls(values)
+        return ConfigSnapshot(groups)
+    def freeze(self):
+        """ The method is used to compile the configuration file and the registered options into a snapshot.
+
+        :return: the new ConfigSnapshot, which snapshot() returns until the options or the file change
+        :raise ValueError: a registered option has an invalid value
+        """
+        state = self.__state
+        if not state.fp:
+            raise Exception("Please invoke method setup first!")
+        state.snapshot = self._compile(state.fp)
+        return state.snapshot
+    def snapshot(self):
+        """ The method is used to get the current snapshot, compiling it if needed.
+
+        :return: ConfigSnapshot
+        """
+        snapshot = self.__state.snapshot
+        if snapshot is None:
+            snapshot = self.freeze()
+        return snapshot
+    def reload(self):
+        """ The method is used to re-read the configuration file and notify the subscribers of the changes.
+
+        The new configuration is parsed and validated before it replaces the old one, so an invalid file
+        leaves the current configuration in place.
 
+        :return: the changes, a dict mapping (group, key) to (old value, new value)
+        :raise ValueError: a registered option has an invalid value in the new file
+        """
+        old = self.__state
+        fp, origin = self._read()
+        values = self._load(fp)
+        snapshot = self._compile(fp)
+        self.__state = _State(fp, values, snapshot, origin)
+        changes = self._diff(self._load(old.fp) if old.fp else dict(), values)
+        for (group, key), (before, after) in sorted(changes.items()):
+            for g, k, callback in list(self.__subscribers):
+                if (g is None or g == group) and (k is None or k == key):
+                    callback(group, key, before, after)
+        return changes
+    def _diff(self, old, new):
+        changes = dict()
+        for group in set(old) | set(new):
+            before, after = old.get(group, dict()), new.get(group, dict())
+            for key in set(before) | set(after):
+                if before.get(key) != after.get(key) or (key in before) != (key in after):
+                    changes[(group, key)] = (before.get(key), after.get(key))
+        return changes
+    def set_override(self, key, value, group='default'):
+        """ The method is used to override a value of the files and the environment.
+
+        :param value: the value as it would be written in the file, non-string values are converted by str
+        :return: the changes, see reload
+        :raise ValueError: the value is invalid, the previous override is kept
+        """
+        return self._override((group, key.lower()), value if isinstance(value, basestring) else str(value))
+    def clear_override(self, key, group='default'):
+        return self._override((group, key.lower()), None)
+    def _override(self, name, value):
+        previous = self.__overrides.pop(name, None)
+        if value is not None:
+            self.__overrides[name] = value
+        try:
+            return self.reload()
+        except Exception:
+            # reload() merges every override, a rejected one would fail all the later reloads.
+            self.__overrides.pop(name, None)
+            if previous is not None:
+                self.__overrides[name] = previous
+            raise
+    def origin(self, key, group='default'):
+        """ The method is used to get the source of a value.
+
+        :return: the file path, 'env:<name>', 'override', 'default' for a registered option missing from
+                 every source, or None for an unknown key
+        """
+        source = self.__state.origin.get((group, key))
+        if source is None and key in self.__opts.get(group, ()):
+            return 'default'
+        return source
+    def subscribe(self, callback, group=None, key=None):
+        """ The method is used to be notified when reload() changes a value.
+
+        :param callback: invoked as callback(group, key, old value, new value)
+        :param group: only the changes of the group, None for every group
+        :param key: only the changes of the key, None for every key
+        """
+        self.__subscribers.append((group, key, callback))
+    def unsubscribe(self, callback):
+        # == as bound methods are new objects on every attribute access.
+        self.__subscribers = [s for s in self.__subscribers if s[2] != callback]
+    def watch(self, interval=1.0):
+        """ The method is used to reload the configuration whenever the file changes.
+
+        :return: the started ConfigWatcher
+        """
+        watcher = ConfigWatcher(self, interval)
+        watcher.start()
+        return watcher
+
+class ConfigWatcher(object):
+    """ The class is used to poll the mtime and size of the configuration files and reload them on change.
+
+        The polling runs in a greenthread when eventlet is installed, monkey patched or not, so the
+        subscribers, e.g. Pool resizing itself, run in the hub's thread like the code they reconfigure.
+        Without eventlet it is a daemon thread. check() may also be invoked directly.
+    """
+    def __init__(self, conf, interval=1.0):
+        self.conf = conf
+        self.interval = interval
+        self.stamp = self._stamp()
+        self.running = False
+        self.thread = None
+        self.errors = 0
+    def _stamp(self):
+        stamp = list()
+        for path in self.conf.files():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stamp.append((path, st.st_mtime, st.st_size))
+        return tuple(stamp)
+    def check(self):
+        """ The method is used to reload the configuration if the file changed since the last check.
+
+        :return: the changes, see ConfigOpts.reload
+        """
+        stamp = self._stamp()
+        if stamp == self.stamp:
+            return dict()
+        self.stamp = stamp
+        return self.conf.reload()
+    def start(self):
+        self.running = True
+        if eventlet is not None:
+            self.thread = eventlet.spawn(self._run)
+            return
+        self.thread = threading.Thread(target=self._run, name="bsl.configure.watcher")
+        self.thread.daemon = True
+        self.thread.start()
+    def stop(self):
+        self.running = False
+    def _run(self):
+        # time.sleep would block the hub when threading is not monkey patched.
+        sleep = eventlet.sleep if eventlet is not None else time.sleep
+        while self.running:
+            sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                # Keep the current configuration and watch for the next edit.
+                self.errors += 1
 
 CONF = ConfigOpts()
 
@@ -247,6 +613,7 @@ if __name__ == "__main__":
     print type(CONF['skp']['unknown']), CONF['skp']['unknown']
     CONF.unregister_opt('unknown', 'skp')
     print CONF.get('unknown', 'skp')
+    print CONF.snapshot().default.abc, CONF.snapshot().skp.d
 
 
 
@@ -1,31 +1,765 @@
 # -*- coding: utf-8 -*-
+import collections, errno, fcntl, hashlib, os, random, socket, sys, time
 import kombu, eventlet
-from eventlet import pools, semaphore, greenlet
+from eventlet import corolocal, event, pools, semaphore, greenlet
+from configure import BoolOpt, DictOpt, IntOpt, FloatOpt, ListOpt, StrOpt
+import codec, log, metrics
+
+rabbit_opts = [IntOpt('pool_size', 'rabbitmq', default=128),
+               IntOpt('prefetch_count', 'rabbitmq', default=0),
+               IntOpt('prefetch_size', 'rabbitmq', default=0),
+               StrOpt('ack_mode', 'rabbitmq', default='single', choices=('single', 'batch')),
+               IntOpt('ack_batch_size', 'rabbitmq', default=64),
+               FloatOpt('ack_interval', 'rabbitmq', default=0.5),
+               StrOpt('dispatch', 'rabbitmq', default='inline'),
+               IntOpt('dispatch_pool_size', 'rabbitmq', default=64),
+               DictOpt('dispatch_pool_sizes', 'rabbitmq', default={}),
+               BoolOpt('dispatch_ordered', 'rabbitmq', default=False),
+               BoolOpt('publish_confirm', 'rabbitmq', default=False),
+               IntOpt('confirm_window', 'rabbitmq', default=1000),
+               FloatOpt('confirm_timeout', 'rabbitmq', default=30),
+               IntOpt('max_batch', 'rabbitmq', default=100),
+               IntOpt('max_wait_ms', 'rabbitmq', default=100),
+               FloatOpt('reconnect_interval', 'rabbitmq', default=1),
+               FloatOpt('reconnect_max_interval', 'rabbitmq', default=30),
+               IntOpt('reconnect_attempts', 'rabbitmq', default=0),
+               IntOpt('pool_min_size', 'rabbitmq', default=0),
+               FloatOpt('pool_idle_timeout', 'rabbitmq', default=0),
+               FloatOpt('pool_max_lifetime', 'rabbitmq', default=0),
+               FloatOpt('pool_reap_interval', 'rabbitmq', default=1),
+               StrOpt('codec', 'rabbitmq', default='json'),
+               DictOpt('codecs', 'rabbitmq', default={}),
+               StrOpt('compression', 'rabbitmq', default=''),
+               IntOpt('compression_threshold', 'rabbitmq', default=1024),
+               FloatOpt('polling_interval', 'rabbitmq', default=0),
+               IntOpt('max_in_flight', 'rabbitmq', default=0),
+               IntOpt('flow_low_watermark', 'rabbitmq', default=0),
+               BoolOpt('dedup', 'rabbitmq', default=False),
+               StrOpt('dedup_key', 'rabbitmq', default='message_id', choices=('message_id', 'hash')),
+               IntOpt('dedup_size', 'rabbitmq', default=100000, min=1),
+               FloatOpt('dedup_ttl', 'rabbitmq', default=3600, min=0),
+               StrOpt('dedup_path', 'rabbitmq', default=''),
+               StrOpt('failure_policy', 'rabbitmq', default='ack', choices=('ack', 'requeue', 'retry', 'park')),
+               ListOpt('retry_delays', 'rabbitmq', default='1,10,60'),
+               IntOpt('max_retries', 'rabbitmq', default=0, min=0),
+               StrOpt('failure_logger', 'rabbitmq', default='bsl.rabbitmq'),
+               FloatOpt('failure_log_interval', 'rabbitmq', default=10, min=0),
+               BoolOpt('channel_per_consumer', 'rabbitmq', default=False),
+               IntOpt('max_channel_revivals', 'rabbitmq', default=5, min=1),
+               FloatOpt('shutdown_timeout', 'rabbitmq', default=20, min=0),
+               FloatOpt('reset_timeout', 'rabbitmq', default=1, min=0)]
+
+metrics.REGISTRY.collect('codecs', codec.stats)
+
+ACK_MODES = ('single', 'batch')
+DISPATCH_MODES = ('inline', 'pool')
+FAILURE_POLICIES = ('ack', 'requeue', 'retry', 'park')
+ATTEMPTS_HEADER = 'x-bsl-attempts'
+REPUBLISHED_PROPERTIES = ('message_id', 'correlation_id', 'reply_to', 'priority', 'timestamp', 'type')
+DEFAULT_CHANNEL = 'default'
+CODEC_OPTIONS = ('codec', 'codecs', 'compression', 'compression_threshold')
+# Seconds a paused drain loop waits for events before it checks for a resume.
+FLOW_POLL_INTERVAL = 0.05
+# Seconds a confirm waiter sleeps before it checks whether it can read the socket itself.
+CONFIRM_POLL_INTERVAL = 0.01
+# The deliveries read by the drain loop of the current greenthread while it
+# runs a callback, see ConsumerBase._receive.
+_loop = corolocal.local()
+
+
+class DeclareCache(object):
+    """Process-wide record of the queues known to exist on a broker.
+
+    Durable queues survive a connection, so once one connection declared
+    them the others, and the recovery after a broker blip, skip the
+    queue.declare round-trips. Exclusive or auto-delete queues are always
+    declared.
+    """
+
+    def __init__(self):
+        self.declared = set()
+        self.declares = 0
+        self.skipped = 0
+
+    def declare(self, queue):
+        key = self._key(queue)
+        if key in self.declared:
+            self.skipped += 1
+            return False
+        queue.declare()
+        self.declares += 1
+        if queue.durable and not queue.auto_delete and not queue.exclusive:
+            self.declared.add(key)
+        return True
+
+    def forget(self, queue=None):
+        """Forget queue, or everything when it is None."""
+        if queue is None:
+            self.declared.clear()
+        else:
+            self.declared.discard(self._key(queue))
+
+    def _key(self, queue):
+        # kombu hands the kombu.Connection to the transport connection as client.
+        client = getattr(queue.channel.connection, 'client', None)
+        broker = client.as_uri() if client is not None else None
+        exchange = queue.exchange.name if queue.exchange is not None else None
+        return broker, queue.name, exchange, queue.routing_key
+
+DECLARED = DeclareCache()
+
+
+class AckTracker(object):
+    """Acknowledge the deliveries of one channel, optionally in batches.
+
+    Delivery tags are scoped to a channel and basic.ack with multiple=True
+    settles every outstanding tag up to the given one, so every consumer
+    sharing the channel must report its deliveries here. A batched ack is
+    only sent up to the lowest tag that is still being processed, which
+    keeps it from settling a message whose callback has not finished yet.
+    kombu's virtual transports (memory://, redis) ignore multiple, so
+    there a batch is settled with one ack per tag.
+    """
+
+    def __init__(self, channel, batch_size=64, interval=0.5, errors=(), multiple=True):
+        """
+        :param channel: the amqp channel the deliveries arrive on
+        :param batch_size: flush once this many acks are pending
+        :param interval: flush pending acks older than this many seconds
+        :param errors: exceptions meaning the channel is gone; pending acks
+                       are dropped on them and the broker redelivers
+        :param multiple: whether the channel honours basic.ack multiple=True
+        """
+        self.channel = channel
+        self.batch_size = batch_size
+        self.interval = interval
+        self.errors = tuple(errors) or (IOError, socket.error)
+        self.multiple = multiple
+        self.unsettled = set()
+        self.done = {}
+        self.since = None
+        self.lock = semaphore.Semaphore()
+        self.frames = metrics.counter('ack_frames')
+
+    def reset(self, channel):
+        """Forget everything pending on the old channel.
+
+        Tags of a dead channel mean nothing on a new one; the unacked
+        messages are redelivered by the broker, so they are never acked twice.
+        """
+        if channel is self.channel:
+            return
+        self.channel = channel
+        self.unsettled = set()
+        self.done = {}
+        self.since = None
+
+    def track(self, message):
+        if message.channel is self.channel:
+            self.unsettled.add(message.delivery_tag)
+
+    def ack(self, message, batch=False):
+        if message.channel is not self.channel:
+            return
+        self.unsettled.discard(message.delivery_tag)
+        if not batch:
+            with self.lock:
+                self._send(message.ack)
+            return
+        self.done[message.delivery_tag] = message
+        if self.since is None:
+            self.since = time.time()
+        if len(self.done) >= self.batch_size:
+            self.flush()
+
+    def reject(self, message, requeue=False):
+        if message.channel is not self.channel:
+            return
+        self.unsettled.discard(message.delivery_tag)
+        with self.lock:
+            self._send(message.reject, requeue=requeue)
+
+    def flush_if_due(self):
+        if self.since is not None and time.time() - self.since >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Ack every finished delivery that has no unfinished delivery
+        below it, with a single multiple ack when the channel supports it."""
+        with self.lock:
+            if not self.done:
+                return
+            low = min(self.unsettled) if self.unsettled else None
+            tags = [tag for tag in self.done if low is None or tag < low]
+            if not tags:
+                return
+            for tag in tags:
+                del self.done[tag]
+            self.since = time.time() if self.done else None
+            if self.multiple:
+                self._send(self.channel.basic_ack, max(tags), multiple=True)
+                return
+            channel = self.channel
+            for tag in sorted(tags):
+                self._send(channel.basic_ack, tag)
+                if channel is not self.channel:
+                    # The channel failed, the remaining tags are void.
+                    return
+
+    def _send(self, method, *args, **kwargs):
+        channel = self.channel
+        self.frames.inc()
+        try:
+            method(*args, **kwargs)
+        except self.errors:
+            # The channel is gone and so are its delivery tags.
+            if channel is self.channel:
+                self.unsettled = set()
+                self.done = {}
+                self.since = None
+
+
+class DedupCache(object):
+    """Keys of the messages already handled, to skip their redeliveries.
+
+    At most 'size' keys are kept, the least recently seen ones are dropped
+    first, and a key expires 'ttl' seconds after it was last seen. With a
+    path, the keys are appended to that file by flush(), every 'interval'
+    seconds from the drain loop, and loaded again by the next process, so
+    the cache survives a restart. Each flush is
+    one O_APPEND write of whole lines, so workers may share the file; they
+    only see the keys of each other when they load it. Once more than
+    twice 'size' lines were read or appended, the file is replaced by a
+    compacted copy, by load() or flush(), so both hold an exclusive flock
+    on it, and a flush finding that the path names another file since it
+    opened it reopens it first.
+    """
+
+    def __init__(self, size=100000, ttl=3600, path=None, interval=0.5):
+        self.size = size
+        self.ttl = ttl
+        self.path = path or None
+        self.interval = interval
+        self.keys = collections.OrderedDict()
+        self.unsaved = []
+        self.since = None
+        # Lines of the file read by the last load or compaction, plus the ones appended since.
+        self.lines = 0
+        self.fd = None
+        if self.path:
+            self.load()
+            self.fd = self._open()
+
+    def __contains__(self, key):
+        """Whether key was seen, refreshing it if so."""
+        seen = self.keys.pop(key, None)
+        if seen is None:
+            return False
+        now = time.time()
+        if self.ttl and now - seen > self.ttl:
+            return False
+        self.keys[key] = now
+        return True
+
+    def add(self, key):
+        now = time.time()
+        self.keys.pop(key, None)
+        self.keys[key] = now
+        if self.fd is not None:
+            self.unsaved.append('%.3f %s\n' % (now, key))
+            if self.since is None:
+                self.since = now
+        self.expire(now)
+
+    def expire(self, now=None):
+        """Drop the keys beyond size and the expired ones; the keys are
+        ordered by the time they were last seen."""
+        while len(self.keys) > self.size:
+            self.keys.popitem(last=False)
+        if self.ttl:
+            deadline = (now or time.time()) - self.ttl
+            while self.keys:
+                key = next(iter(self.keys))
+                if self.keys[key] >= deadline:
+                    break
+                del self.keys[key]
+
+    def flush_if_due(self):
+        if self.since is not None and time.time() - self.since >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self.unsaved:
+            return
+        lines, self.unsaved, self.since = ''.join(self.unsaved), [], None
+        while True:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            if self._current(self.fd):
+                break
+            # Compacted by another worker, the old file is unlinked.
+            os.close(self.fd)
+            self.fd = self._open()
+        compacted = False
+        try:
+            os.write(self.fd, lines)
+            self.lines += lines.count('\n')
+            if self.lines > 2 * self.size:
+                with open(self.path) as fp:
+                    compacted = self._load(fp)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        if compacted:
+            os.close(self.fd)
+            self.fd = self._open()
+
+    def _open(self):
+        return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+
+    def _current(self, fd):
+        """Whether path still names the file fd is open on."""
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        fst = os.fstat(fd)
+        return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+    def load(self):
+        """Read the keys of path and compact the file if most of its
+        lines are stale."""
+        while True:
+            try:
+                fp = open(self.path)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return
+            # Held until the rename, the appends of the other workers wait.
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            if self._current(fp.fileno()):
+                break
+            fp.close()
+        with fp:
+            self._load(fp)
+
+    def _load(self, fp):
+        """Merge the keys of fp, the caller holding the flock, and compact
+        the file if most of its lines are stale.
+
+        :return: whether the file was replaced
+        """
+        lines = fp.readlines()
+        # Ordered, so that the sort keeps the keys seen in the same millisecond in order.
+        keys = collections.OrderedDict(self.keys)
+        for line in lines:
+            try:
+                seen, key = line.split()
+                seen = float(seen)
+            except ValueError:
+                # A line cut short by a crash.
+                continue
+            if seen > keys.get(key, 0):
+                keys[key] = seen
+        self.keys = collections.OrderedDict(sorted(keys.items(), key=lambda item: item[1]))
+        self.expire()
+        self.lines = len(lines)
+        if len(lines) <= 2 * len(self.keys):
+            return False
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as out:
+            out.writelines('%.3f %s\n' % (seen, key) for key, seen in self.keys.items())
+        os.rename(tmp, self.path)
+        self.lines = len(self.keys)
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            self.flush()
+            os.close(self.fd)
+            self.fd = None
+
+# The unavailable codecs already reported, so that every pooled connection does not.
+_MISSING_CODECS = set()
+
+_dedup_cache = None
+_dedup_create_sem = semaphore.Semaphore()
+
+
+def get_dedup_cache(conf):
+    """Return the process-wide DedupCache, created from conf on first use."""
+    global _dedup_cache
+    with _dedup_create_sem:
+        if _dedup_cache is None:
+            _dedup_cache = DedupCache(conf.get('dedup_size', 'rabbitmq'),
+                                      conf.get('dedup_ttl', 'rabbitmq'),
+                                      conf.get('dedup_path', 'rabbitmq'),
+                                      conf.get('ack_interval', 'rabbitmq'))
+    return _dedup_cache
+
+
+class FailurePolicy(object):
+    """Settle the deliveries whose callback raised.
+
+    'ack' drops the message, 'requeue' hands it back to the broker, which
+    redelivers it at once, 'park' moves it to the '<queue>.parked' queue
+    and 'retry' republishes it to a '<queue>.retry.<delay>' queue. Those
+    hold it for the delay of its attempt (the last of delays for the later
+    attempts) then dead-letter it back to the queue through the default
+    exchange, so only the failing consumer sees it again. After
+    max_retries attempts, by default one per delay, it is parked. The
+    attempts are counted in the x-bsl-attempts header; the broker must
+    support per-queue TTL and dead-lettering, as RabbitMQ does. The message
+    is republished before it is acked, so a crash in between redelivers
+    it, but the republish is not confirmed: a message the broker fails to
+    route or store is lost.
+
+    Failures are logged to the 'logger' bsl.log logger, or the logging one
+    if bsl.log does not know it, at most once per log_interval seconds and
+    topic, with the number of failures left out since the previous entry.
+    """
+
+    def __init__(self, mode='ack', delays=(1, 10, 60), max_retries=0, logger='bsl.rabbitmq', log_interval=10):
+        if mode not in FAILURE_POLICIES:
+            raise ValueError("Unknown failure policy: %s" % mode)
+        self.mode = mode
+        self.delays = [float(delay) for delay in delays] or [1.0]
+        self.max_retries = max_retries or len(self.delays)
+        self.logger = logger
+        self.log_interval = log_interval
+        self.logged = {}
+
+    def retry_queue(self, name, attempt):
+        return '%s.retry.%g' % (name, self.delays[min(attempt, len(self.delays) - 1)])
+
+    def declare(self, consumer):
+        """Declare the retry and parking queues of consumer's queue."""
+        if self.mode not in ('retry', 'park'):
+            return
+        name = consumer.queue.name
+        DECLARED.declare(kombu.Queue('%s.parked' % name, routing_key='%s.parked' % name,
+                                     channel=consumer.channel, durable=True, auto_delete=False))
+        if self.mode != 'retry':
+            return
+        for delay in self.delays:
+            retry = '%s.retry.%g' % (name, delay)
+            DECLARED.declare(kombu.Queue(retry, routing_key=retry, channel=consumer.channel,
+                                         durable=True, auto_delete=False,
+                                         queue_arguments={'x-message-ttl': int(delay * 1000),
+                                                          'x-dead-letter-exchange': '',
+                                                          'x-dead-letter-routing-key': name}))
+
+    def handle(self, consumer, message, error, batch=False):
+        """Settle message after its callback raised error."""
+        self.log(consumer, error)
+        if self.mode == 'ack':
+            consumer.acker.ack(message, batch)
+            return
+        if self.mode == 'requeue':
+            consumer.acker.reject(message, True)
+            return
+        name = consumer.queue.name
+        headers = dict(message.headers or {})
+        attempts = headers.get(ATTEMPTS_HEADER, 0)
+        if self.mode == 'retry' and attempts < self.max_retries:
+            headers[ATTEMPTS_HEADER] = attempts + 1
+            self.publish(consumer, message, self.retry_queue(name, attempts), headers)
+            consumer.retried.inc()
+        else:
+            headers['x-bsl-error'] = ('%s: %s' % (type(error).__name__, error))[:1024]
+            self.publish(consumer, message, '%s.parked' % name, headers)
+            consumer.parked.inc()
+        consumer.acker.ack(message, batch)
+
+    def publish(self, consumer, message, queue, headers):
+        properties = dict((key, message.properties[key]) for key in REPUBLISHED_PROPERTIES
+                          if message.properties.get(key) is not None)
+        kombu.Producer(consumer.channel).publish(message.body, routing_key=queue,
+                                                 content_type=message.content_type,
+                                                 content_encoding=message.content_encoding,
+                                                 headers=headers, delivery_mode=2, **properties)
+
+    def log(self, consumer, error):
+        topic = consumer.queue.name
+        now = time.time()
+        last, suppressed = self.logged.get(topic, (0, 0))
+        if now - last < self.log_interval:
+            self.logged[topic] = (last, suppressed + 1)
+            return
+        self.logged[topic] = (now, 0)
+        log.lookup(self.logger).error("Callback of %s failed, %s (policy %s, %d failures not logged)",
+                     topic, error, self.mode, suppressed, exc_info=sys.exc_info())
+
+
+class Dispatcher(object):
+    """Run consumer callbacks on a bounded GreenPool.
+
+    dispatch() blocks the drain loop while the pool is full. With ordered
+    set, the messages of one routing key are handled one after another by
+    a single greenthread, while different routing keys still run
+    concurrently; dispatch() then blocks while size messages are queued
+    or running, whatever their keys.
+    """
+
+    def __init__(self, size, ordered=False):
+        self.pool = eventlet.GreenPool(size)
+        self.ordered = ordered
+        self.backlog = {}
+        self.slots = semaphore.Semaphore(size)
+
+    def dispatch(self, key, func, *args):
+        if not self.ordered:
+            self.pool.spawn_n(func, *args)
+            return
+        self.slots.acquire()
+        if key in self.backlog:
+            self.backlog[key].append((func, args))
+            return
+        self.backlog[key] = collections.deque([(func, args)])
+        self.pool.spawn_n(self._run, key)
+
+    def _run(self, key):
+        backlog = self.backlog[key]
+        try:
+            while backlog:
+                func, args = backlog.popleft()
+                try:
+                    func(*args)
+                finally:
+                    self.slots.release()
+        finally:
+            del self.backlog[key]
+
+    def running(self):
+        return self.pool.running() + sum(len(b) for b in self.backlog.values())
+
+    def waitall(self):
+        self.pool.waitall()
+
+
+def _is_open(channel):
+    # amqp channels have is_open, the virtual ones of kombu closed.
+    return getattr(channel, 'is_open', not getattr(channel, 'closed', False))
+
+
+class ChannelManager(object):
+    """The channels of a broker connection by group, each with the
+    AckTracker of its deliveries.
+
+    A channel is opened on the first get() of its group and reused by the
+    later ones. A channel-level error, e.g. a failed declare or an ack of
+    an unknown tag, only closes the channel it happened on; revive() opens
+    a new channel for each closed group while the other channels, and the
+    deliveries in flight on them, carry on.
+    """
+
+    def __init__(self, batch_size=64, interval=0.5):
+        """
+        :param batch_size: ack_batch_size of the AckTrackers
+        :param interval: ack_interval of the AckTrackers
+        """
+        self.batch_size = batch_size
+        self.interval = interval
+        self.connection = None
+        self.errors = ()
+        self.multiple = True
+        self.channels = {}
+        self.ackers = {}
+        self.revivals = metrics.counter('channel_revivals')
+
+    def attach(self, connection):
+        """Open the channels of every known group on a new kombu connection."""
+        self.connection = connection
+        self.errors = connection.connection_errors + connection.channel_errors
+        # Only AMQP brokers settle every tag up to the one of a multiple ack.
+        self.multiple = connection.transport.driver_type == 'amqp'
+        for group in self.channels:
+            self._open(group)
+
+    def get(self, group=DEFAULT_CHANNEL):
+        """
+        :return: the channel of group and its AckTracker
+        """
+        if group not in self.channels:
+            self._open(group)
+        return self.channels[group], self.ackers[group]
+
+    def _open(self, group):
+        channel = self.channels[group] = self.connection.channel()
+        if group in self.ackers:
+            self.ackers[group].reset(channel)
+            self.ackers[group].multiple = self.multiple
+        else:
+            self.ackers[group] = AckTracker(channel, self.batch_size, self.interval, self.errors, self.multiple)
+
+    def revive(self):
+        """Reopen the channels closed by the broker.
+
+        :return: the groups of the reopened channels
+        """
+        closed = [group for group, channel in self.channels.items() if not _is_open(channel)]
+        for group in closed:
+            self._open(group)
+            self.revivals.inc()
+        return closed
+
+    def flush(self):
+        for acker in self.ackers.values():
+            acker.flush()
+
+    def __len__(self):
+        return len(self.channels)
+
+
+class FlowControl(object):
+    """Count the deliveries of a connection from their receipt until their
+    callback has returned, and signal an overload past a high watermark.
+
+    The count goes up in the drain loop and down wherever the callbacks
+    run, so with dispatch='pool', ordered dispatch or batch consumers it
+    bounds what is buffered in the process. Once 'high' deliveries are in
+    flight the flow is paused, and it is resumed when the count falls back
+    to 'low'; the Connection applies that to its consumers. Subscribers are
+    called with True on a pause and False on a resume.
+    """
+
+    def __init__(self, high=0, low=0):
+        """
+        :param high: pause at this many deliveries in flight, 0 never pauses
+        :param low: resume at this many, defaults to half of high
+        """
+        self.high = high
+        self.low = min(low or high // 2, max(high - 1, 0))
+        self.in_flight = 0
+        # Deliveries whose callback returned, in total.
+        self.completed = 0
+        self.paused = False
+        self.paused_at = None
+        self.subscribers = []
+        self.pauses = metrics.counter('flow_pauses')
+        self.paused_seconds = metrics.counter('flow_paused_seconds')
+        self.gauge = metrics.gauge('messages_in_flight')
+        self.paused_gauge = metrics.gauge('connections_paused')
+
+    def acquire(self, count=1):
+        self.in_flight += count
+        self.gauge.inc(count)
+        if self.high and not self.paused and self.in_flight >= self.high:
+            self.paused, self.paused_at = True, time.time()
+            self.pauses.inc()
+            self.paused_gauge.inc()
+            self._notify()
+
+    def release(self, count=1):
+        self.in_flight -= count
+        self.completed += count
+        self.gauge.dec(count)
+        if self.paused and self.in_flight <= self.low:
+            self.paused = False
+            self.paused_seconds.inc(time.time() - self.paused_at)
+            self.paused_gauge.dec()
+            self._notify()
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers = [s for s in self.subscribers if s is not callback]
+
+    def _notify(self):
+        for callback in list(self.subscribers):
+            callback(self.paused)
+
+
 class ConsumerBase(object):
     """Consumer base class."""
 
-    def __init__(self, channel, callback, tag, **kwargs):
+    # Seconds between two tick() calls the consumer needs, None for no limit.
+    tick_interval = None
+    # The ChannelManager group of the consumer's channel.
+    channel_group = DEFAULT_CHANNEL
+
+    def __init__(self, channel, callback, tag, acker=None, prefetch_count=0,
+                 prefetch_size=0, ack_mode='single', dispatcher=None, codec=None, flow=None,
+                 dedup=None, dedup_key='message_id', failure=None, **kwargs):
         """Declare a queue on an amqp channel.
 
         'channel' is the amqp channel to use
         'callback' is the callback to call when messages are received
         'tag' is a unique ID for the consumer on the channel
+        'acker' is the AckTracker shared by the consumers of the channel
+        'prefetch_count'/'prefetch_size' limit the unacked deliveries the
+        broker pushes to this consumer, 0 means unlimited
+        'ack_mode' is 'single' to ack every message on its own or 'batch'
+        to coalesce the acks through the AckTracker
+        'dispatcher' is an optional Dispatcher running the callbacks off the
+        drain loop, None runs them inline
+        'codec' names the codec.REGISTRY codec decoding the bodies, None
+        picks it by content type and leaves unknown ones to kombu
+        'flow' is the FlowControl of the connection, counting the
+        deliveries until their callback has returned
+        'dedup' is an optional DedupCache; deliveries whose key is in it, or
+        is the key of a delivery still being handled, are acked without
+        calling the callback, and the key of every delivery whose callback
+        returned is added to it
+        'dedup_key' is 'message_id' to key on the message_id property, the
+        messages without one are never skipped, 'hash' to key on the body,
+        or a function returning the key of a message
+        'failure' is the FailurePolicy settling the deliveries whose callback
+        raised, by default they are acked and logged
 
         queue name, exchange name, and other kombu options are
         passed in here as a dictionary.
         """
+        if ack_mode not in ACK_MODES:
+            raise ValueError("Unknown ack mode: %s" % ack_mode)
         self.callback = callback
         self.tag = str(tag)
         self.kwargs = kwargs
         self.queue = None
+        self.prefetch_count = prefetch_count
+        self.prefetch_size = prefetch_size
+        self.ack_mode = ack_mode
+        self.acker = acker or AckTracker(channel)
+        self.dispatcher = dispatcher
+        self.codec = codec or None
+        self.flow = flow or FlowControl()
+        self.consuming = False
+        self.dedup = dedup
+        self.dedup_key = dedup_key
+        self.failure = failure or FailurePolicy()
+        topic = kwargs.get('name')
+        self.received = metrics.counter('messages_received', topic=topic)
+        self.acked = metrics.counter('messages_acked', topic=topic)
+        self.failed = metrics.counter('messages_failed', topic=topic)
+        self.latency = metrics.histogram('callback_seconds', topic=topic)
+        self.dedup_hits = metrics.counter('dedup_hits', topic=topic)
+        self.dedup_misses = metrics.counter('dedup_misses', topic=topic)
+        self.retried = metrics.counter('messages_retried', topic=topic)
+        self.parked = metrics.counter('messages_parked', topic=topic)
+        # Seconds spent handling deliveries in the drain loop.
+        self.busy_seconds = 0.0
+        # Re-attachments in a row that failed with a channel error, see Connection._attach.
+        self.revive_failures = 0
+        # Whether the drain loop runs a callback of the consumer, see _run.
+        self.delivering = False
+        # The dedup keys of the deliveries received and not settled yet.
+        self.in_flight = set()
         self.reconnect(channel)
 
     def reconnect(self, channel):
-        """Re-declare the queue after a rabbit reconnect"""
+        """Re-declare the queue after a rabbit reconnect
+
+        The declare is skipped when DECLARED knows the queue exists.
+        """
         self.channel = channel
         self.kwargs['channel'] = channel
+        self.consuming = False
+        self.acker.reset(channel)
         self.queue = kombu.entity.Queue(**self.kwargs)#若参数值含有Exchange，那么会直接绑定上去
-        self.queue.declare()
+        DECLARED.declare(self.queue)
+        self.failure.declare(self)
 
     def consume(self, *args, **kwargs):
         """Actually declare the consumer on the amqp channel.  This will
@@ -42,7 +776,9 @@ class ConsumerBase(object):
         参数noack : If enabled the broker will automatically ack messages.
 
         Messages will automatically be acked if the callback doesn't
-        raise an exception
+        raise an exception, otherwise the failure policy settles them. In 'batch' ack mode the acks are coalesced and
+        sent by tick() or once ack_batch_size of them are pending. With a
+        dispatcher the message is acked once its callback has returned.
         """
 
         options = {'consumer_tag': self.tag}
@@ -50,28 +786,161 @@ class ConsumerBase(object):
         callback = kwargs.get('callback', self.callback)
         if not callback:
             raise ValueError("No callback defined")
+        batch = self.ack_mode == 'batch'
 
-        def _callback(raw_message):
-            message = self.channel.message_to_python(raw_message)#将消息解码成python能识别的值
+        def _process(message, key):
+            start = time.time()
             try:
                 # msg = rpc_common.deserialize_msg(message.payload)#payload是已经解码的消息
-                callback(message.payload)#回调函数处理该msg
-            except Exception:
-                pass
+                callback(self.decode(message))#回调函数处理该msg
+            except Exception as e:
+                self.latency.observe(time.time() - start)
+                self.failed.inc()
+                try:
+                    self.failure.handle(self, message, e, batch)
+                finally:
+                    self.in_flight.discard(key)
+                    self.flow.release()
+                return
+            try:
+                self.latency.observe(time.time() - start)
+                self.acker.ack(message, batch)#Acknowledge this message as being processed., This will remove the message from the queue.
+                self.acked.inc()
+                if key is not None:
+                    self.dedup.add(key)
             finally:
-                message.ack()#Acknowledge this message as being processed., This will remove the message from the queue.
+                self.in_flight.discard(key)
+                self.flow.release()
+
+        def _callback(raw_message):
+            start = time.time()
+            message = self.channel.message_to_python(raw_message)#将消息解码成python能识别的值
+            self.received.inc()
+            self.acker.track(message)
+            key = self.key(message)
+            if key is not None:
+                if self.skip(message, key, batch):
+                    self.busy_seconds += time.time() - start
+                    return
+                self.in_flight.add(key)
+            self.flow.acquire()
+            if self.dispatcher is None:
+                _process(message, key)
+            else:
+                self.dispatcher.dispatch(message.delivery_info.get('routing_key'), _process, message, key)
+            self.busy_seconds += time.time() - start
+
+        if self.prefetch_count or self.prefetch_size:
+            # Not global, so the limit applies to the consumer started below.
+            self.channel.basic_qos(self.prefetch_size, self.prefetch_count, False)
+        self.consuming = True
+        self.on_message = _callback
+        self._consume(args, self._receive, options)#Start a queue consumer   consume(consumer_tag='', callback=None, no_ack=None, nowait=False)
+
+    def _receive(self, raw_message):
+        """The kombu callback of the consumer.
 
-        self.queue.consume(*args, callback=_callback, **options)#Start a queue consumer   consume(consumer_tag='', callback=None, no_ack=None, nowait=False)
+        A callback running in the drain loop may read the socket itself,
+        e.g. an RPC call waiting for its reply; the deliveries it reads are
+        handled once it returned rather than recursively.
+        """
+        deferred = getattr(_loop, 'deferred', None)
+        if deferred is not None:
+            deferred.append((self, raw_message))
+            return
+        self._run(self.on_message, raw_message)
+
+    def _run(self, func, *args):
+        """Run func in the drain loop, then the deliveries deferred meanwhile."""
+        _loop.deferred = deferred = collections.deque()
+        self.delivering = True
+        try:
+            func(*args)
+            while deferred:
+                consumer, raw_message = deferred.popleft()
+                consumer.on_message(raw_message)
+        finally:
+            _loop.deferred = None
+            self.delivering = False
+
+    def _consume(self, args, callback, options):
+        try:
+            self.queue.consume(*args, callback=callback, **options)
+        except Exception as e:
+            if getattr(e, 'reply_code', getattr(e, 'code', None)) == 404:
+                # The queue was deleted behind our back, declare it again.
+                DECLARED.forget(self.queue)
+            raise
 
     def cancel(self):
         """Cancel the consuming from the queue, if it has started"""
+        if self.consuming:
+            self.pause()
+        self.queue = None
+
+    def pause(self):
+        """Stop the deliveries but keep the queue, consume() resumes them.
+
+        Deliveries the broker sent before the cancel reached it are
+        rejected with requeue by the channel.
+        """
         try:
             self.queue.cancel(self.tag)
         except KeyError, e:
             # NOTE(comstud): Kludge to get around a amqplib bug
             if str(e) != "u'%s'" % self.tag:
                 raise
-        self.queue = None
+        self.consuming = False
+
+    def decode(self, message):
+        """Return the payload of message, decoded by the codec registry."""
+        if self.codec is None and not codec.REGISTRY.knows(message.content_type, message.headers):
+            return message.payload
+        return codec.decode(message.body, message.content_type, message.headers, self.codec)
+
+    def key(self, message):
+        """Return the dedup key of message, None when it is not deduplicated."""
+        if self.dedup is None:
+            return None
+        if self.dedup_key == 'message_id':
+            value = message.properties.get('message_id')
+            if value is None:
+                return None
+        elif self.dedup_key == 'hash':
+            value = message.body
+        else:
+            value = self.dedup_key(message)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        # Fixed-size keys, safe to write to the file, and scoped to the queue.
+        return hashlib.sha1('%s\0%s' % (self.queue.name, value)).hexdigest()
+
+    def skip(self, message, key, batch=False):
+        """Ack message if key was seen already.
+
+        :return: True if the message was a duplicate
+        """
+        if key in self.in_flight or key in self.dedup:
+            # A redelivery after a reconnect may arrive while the first
+            # copy is still handled, e.g. by dispatch='pool'.
+            self.dedup_hits.inc()
+            self.acker.ack(message, batch)
+            return True
+        self.dedup_misses.inc()
+        return False
+
+    def tick(self):
+        """Called by the drain loop after every event or timeout."""
+        self.acker.flush_if_due()
+        if self.dedup is not None:
+            self.dedup.flush_if_due()
+
+    def wait(self):
+        """Wait for the dispatched callbacks to finish."""
+        if self.dispatcher is not None:
+            self.dispatcher.waitall()
+        if self.dedup is not None:
+            self.dedup.flush()
 
 class TopicConsumer(ConsumerBase):
     """Consumer class for 'topic'"""
@@ -87,6 +956,9 @@ class TopicConsumer(ConsumerBase):
         :param tag: a unique ID for the consumer on the channel
         :param name: optional queue name, defaults to topic
         :paramtype name: str
+        :param exchange_durable: defaults to durable, the exchange is shared
+                                 by the queues bound to it
+        :param exchange_auto_delete: defaults to auto_delete
 
         Other kombu options may be passed as keyword arguments
         """
@@ -98,25 +970,406 @@ class TopicConsumer(ConsumerBase):
         exchange_name = exchange_name
         exchange = kombu.Exchange(name=exchange_name,
                                          type='topic',
-                                         durable=options['durable'],
-                                         auto_delete=options['auto_delete'])
+                                         durable=options.pop('exchange_durable', options['durable']),
+                                         auto_delete=options.pop('exchange_auto_delete', options['auto_delete']))
         super(TopicConsumer, self).__init__(channel,
                                             callback,
                                             tag,
-                                            name=topic,
+                                            name=options.pop('name', topic),
                                             exchange=exchange,
                                             routing_key=topic,
                                             **options)
 
+class BatchConsumer(ConsumerBase):
+    """Consumer delivering lists of messages to the callback.
+
+    Deliveries are accumulated until max_batch of them are buffered or the
+    oldest one has waited max_wait_ms, then the callback is called once
+    with the list of payloads. On success the whole batch is settled with
+    one flush of the AckTracker, if the callback raises every message of the
+    batch is rejected, and requeued when requeue is set, unless the failure
+    policy is 'retry' or 'park' and handles each of them. Only the keys of
+    acked batches are added to the dedup cache; a redelivery of a message
+    buffered or in a batch being handled is a duplicate too.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.max_batch = kwargs.pop('max_batch', 100)
+        self.tick_interval = kwargs.pop('max_wait_ms', 100) / 1000.0
+        self.requeue = kwargs.pop('requeue', True)
+        self.batch = []
+        self.keys = []
+        self.since = None
+        super(BatchConsumer, self).__init__(*args, **kwargs)
+        if self.prefetch_count:
+            # A smaller prefetch would only ever fill a batch on timeout.
+            self.prefetch_count = max(self.prefetch_count, self.max_batch)
+
+    def consume(self, *args, **kwargs):
+        """Start consuming, see ConsumerBase.consume."""
+        options = {'consumer_tag': self.tag}
+        options['nowait'] = kwargs.get('nowait', False)
+        callback = kwargs.get('callback', self.callback)
+        if not callback:
+            raise ValueError("No callback defined")
+        self.batch_callback = callback
+
+        def _callback(raw_message):
+            start = time.time()
+            message = self.channel.message_to_python(raw_message)
+            self.received.inc()
+            self.acker.track(message)
+            key = self.key(message)
+            if key is not None:
+                if self.skip(message, key, True):
+                    self.busy_seconds += time.time() - start
+                    return
+                self.in_flight.add(key)
+            self.flow.acquire()
+            if not self.batch:
+                self.since = start
+            self.batch.append(message)
+            self.keys.append(key)
+            if len(self.batch) >= self.max_batch:
+                self.flush()
+            self.busy_seconds += time.time() - start
+
+        if self.prefetch_count or self.prefetch_size:
+            self.channel.basic_qos(self.prefetch_size, self.prefetch_count, False)
+        self.consuming = True
+        self.on_message = _callback
+        self._consume(args, self._receive, options)
+
+    def reconnect(self, channel):
+        # The buffered messages belong to the old channel and get redelivered.
+        if self.batch:
+            self.flow.release(len(self.batch))
+        self.in_flight.difference_update(self.keys)
+        self.batch, self.keys, self.since = [], [], None
+        super(BatchConsumer, self).reconnect(channel)
+
+    def flush(self):
+        """Hand the buffered messages to the callback."""
+        if not self.batch:
+            return
+        batch, keys = self.batch, self.keys
+        self.batch, self.keys, self.since = [], [], None
+        if self.dispatcher is None:
+            self._process(batch, keys)
+        else:
+            self.dispatcher.dispatch(None, self._process, batch, keys)
+
+    def _process(self, batch, keys=()):
+        start = time.time()
+        try:
+            self.batch_callback([self.decode(message) for message in batch])
+        except Exception as e:
+            self.latency.observe(time.time() - start)
+            self.failed.inc(len(batch))
+            try:
+                if self.failure.mode in ('retry', 'park'):
+                    for message in batch:
+                        self.failure.handle(self, message, e, True)
+                    self.acker.flush()
+                else:
+                    self.failure.log(self, e)
+                    for message in batch:
+                        self.acker.reject(message, self.requeue)
+            finally:
+                self.in_flight.difference_update(keys)
+                self.flow.release(len(batch))
+            return
+        self.latency.observe(time.time() - start)
+        for message in batch:
+            self.acker.ack(message, True)
+        self.acker.flush()
+        self.acked.inc(len(batch))
+        for key in keys:
+            if key is not None:
+                self.dedup.add(key)
+        self.in_flight.difference_update(keys)
+        self.flow.release(len(batch))
+
+    def tick(self):
+        if self.since is not None and time.time() - self.since >= self.tick_interval:
+            self._run(self.flush)
+        super(BatchConsumer, self).tick()
+
+    def wait(self):
+        self.flush()
+        super(BatchConsumer, self).wait()
+
+class BatchTopicConsumer(BatchConsumer, TopicConsumer):
+    """Batch consumer class for 'topic'
+
+    Takes the arguments of TopicConsumer plus max_batch, max_wait_ms and
+    requeue.
+    """
+
+class PublishError(Exception):
+    """Raised when the broker nacks a publish or does not confirm it in time."""
+
+
+class Publisher(object):
+    """Publish on a channel of its own.
+
+    Exchanges and producers are cached per exchange name, so a publish
+    costs one basic.publish. With confirm enabled the channel is put in
+    confirm mode and the broker acks arrive asynchronously; publish() only
+    waits once 'window' publishes are outstanding and wait_for_confirms()
+    waits for the rest. Every confirm wakes all the waiting greenthreads,
+    and one of them at a time reads the socket unless the drain loop does.
+    """
+
+    def __init__(self, connection, confirm=False, window=1000, timeout=30, is_draining=None):
+        """
+        :param connection: the kombu connection to publish on
+        :param confirm: use publisher confirms
+        :param window: the number of unconfirmed publishes allowed
+        :param timeout: seconds to wait for confirms before PublishError
+        :param is_draining: returns True while another greenthread runs
+                            drain_events() on the connection, in which case
+                            the publisher waits instead of reading the socket,
+                            see Connection.is_draining
+        """
+        self.connection = connection
+        self.channel = connection.channel()
+        self.window = window
+        self.timeout = timeout
+        self.is_draining = is_draining or (lambda: False)
+        self.producers = {}
+        self.seq = 0
+        self.unconfirmed = set()
+        self.nacked = 0
+        # An event per waiting greenthread, sent on every confirm.
+        self.waiters = []
+        self.lock = semaphore.Semaphore()
+        # Transports without confirm_select (e.g. memory://) never lose a publish.
+        self.confirm = confirm and hasattr(self.channel, 'confirm_select')
+        if self.confirm:
+            self.channel.confirm_select()
+            self.channel.events['basic_ack'].add(self._on_ack)
+            self.channel.events['basic_nack'].add(self._on_nack)
+
+    def producer(self, exchange_name):
+        producer = self.producers.get(exchange_name)
+        if producer is None:
+            exchange = kombu.Exchange(name=exchange_name, type='topic', durable=True, auto_delete=False)
+            producer = kombu.Producer(self.channel, exchange)
+            self.producers[exchange_name] = producer
+        return producer
+
+    def publish(self, exchange_name, topic, payload, **kwargs):
+        self.producer(exchange_name).publish(payload, routing_key=topic, **kwargs)
+        if self.confirm:
+            self.seq += 1
+            self.unconfirmed.add(self.seq)
+            if len(self.unconfirmed) >= self.window:
+                self._wait(lambda: len(self.unconfirmed) < self.window)
+
+    def wait_for_confirms(self, timeout=None):
+        """Wait until every publish so far is confirmed.
+
+        :raise PublishError: some publishes were nacked or timed out
+        """
+        if self.confirm:
+            self._wait(lambda: not self.unconfirmed, timeout)
+        nacked, self.nacked = self.nacked, 0
+        if nacked:
+            raise PublishError("%d messages were nacked by the broker" % nacked)
+
+    def _settle(self, tag, multiple):
+        if multiple:
+            settled = set(seq for seq in self.unconfirmed if seq <= tag)
+            self.unconfirmed -= settled
+        else:
+            settled = set([tag]) & self.unconfirmed
+            self.unconfirmed.discard(tag)
+        for waiter in self.waiters:
+            if not waiter.ready():
+                waiter.send()
+        return len(settled)
+
+    def _on_ack(self, tag, multiple):
+        self._settle(tag, multiple)
+
+    def _on_nack(self, tag, multiple):
+        self.nacked += self._settle(tag, multiple)
+
+    def _wait(self, done, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        while not done():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise PublishError("%d messages were not confirmed in %ss" % (len(self.unconfirmed), timeout))
+            if self.is_draining():
+                self._sleep(remaining)
+            elif self.lock.acquire(blocking=False):
+                try:
+                    self.connection.drain_events(timeout=remaining)
+                except socket.timeout:
+                    pass
+                finally:
+                    self.lock.release()
+            else:
+                # Another waiter reads the socket; take over if it is done.
+                self._sleep(min(remaining, CONFIRM_POLL_INTERVAL))
+
+    def _sleep(self, timeout):
+        """Wait for the next confirm, at most timeout seconds."""
+        waiter = event.Event()
+        self.waiters.append(waiter)
+        try:
+            with eventlet.Timeout(timeout, False):
+                waiter.wait()
+        finally:
+            self.waiters.remove(waiter)
+
+
 class Pool(pools.Pool):
+    """Pool of connections.
+
+    pool_min_size connections are opened when the pool is created and kept
+    open. A connection is probed with is_alive() when it is checked out and
+    when it is put back, and dead ones are replaced. Free connections idle
+    for pool_idle_timeout seconds beyond the minimum, or open for more than
+    pool_max_lifetime seconds, are closed; 0 disables either limit. A
+    greenthread checks them every pool_reap_interval seconds until
+    shutdown(), 0 leaves it to explicit reap() calls.
+
+    The sizes and limits follow the [rabbitmq] section when conf is reloaded.
+    """
     def __init__(self, conf, connection_cls, **kwargs):
         self.connection_cls = connection_cls
         self.kwargs = kwargs
         self.conf = conf
+        conf.register_opts(rabbit_opts)
         max_size = conf.get('pool_size', 'rabbitmq', default=128)
-        super(Pool, self).__init__(max_size = max_size)
+        min_size = conf.get('pool_min_size', 'rabbitmq')
+        self.idle_timeout = conf.get('pool_idle_timeout', 'rabbitmq')
+        self.max_lifetime = conf.get('pool_max_lifetime', 'rabbitmq')
+        self.reap_interval = conf.get('pool_reap_interval', 'rabbitmq')
+        self.reaper = None
+        self.counters = {'creates': 0, 'evictions': 0, 'checkouts': 0,
+                         'wait_time': 0.0, 'max_wait_time': 0.0}
+        self.closed = False
+        self.checkout = metrics.histogram('pool_checkout_seconds', pool=connection_cls.__name__)
+        metrics.REGISTRY.collect('pool.%s' % connection_cls.__name__, self.stats)
+        super(Pool, self).__init__(min_size=min(min_size, max_size), max_size = max_size)
+        self._start_reaper()
+        if hasattr(conf, 'subscribe'):
+            conf.subscribe(self._on_conf_change, 'rabbitmq')
+    def _on_conf_change(self, group, key, old, new):
+        if key == 'pool_size':
+            self.resize(new)
+        elif key == 'pool_min_size':
+            self.min_size = min(new, self.max_size)
+            self.reap()
+        elif key == 'pool_idle_timeout':
+            self.idle_timeout = new
+        elif key == 'pool_max_lifetime':
+            self.max_lifetime = new
+        elif key == 'pool_reap_interval':
+            self.reap_interval = new
+            self._start_reaper()
     def create(self):
-        return self.connection_cls(self.conf, **self.kwargs)
+        connection = self.connection_cls(self.conf, **self.kwargs)
+        connection.last_used = time.time()
+        self.counters['creates'] += 1
+        return connection
+    def get(self):
+        start = time.time()
+        while True:
+            connection = super(Pool, self).get()
+            if self._usable(connection, start):
+                break
+            self._evict(connection)
+        wait = time.time() - start
+        self.checkout.observe(wait)
+        self.counters['checkouts'] += 1
+        self.counters['wait_time'] += wait
+        self.counters['max_wait_time'] = max(self.counters['max_wait_time'], wait)
+        return connection
+    def put(self, connection):
+        if self.closed or not connection.is_alive():
+            self._evict(connection)
+            return
+        connection.last_used = time.time()
+        super(Pool, self).put(connection)
+    def _usable(self, connection, now):
+        if self.max_lifetime and now - connection.created_at > self.max_lifetime:
+            return False
+        return connection.is_alive()
+    def _evict(self, connection):
+        self.current_size -= 1
+        self.counters['evictions'] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+        # A greenthread blocked in get() is only woken up by a put().
+        if self.waiting() and not self.closed and self.current_size < self.max_size:
+            self.current_size += 1
+            try:
+                connection = self.create()
+            except Exception:
+                self.current_size -= 1
+                return
+            super(Pool, self).put(connection)
+    def _start_reaper(self):
+        if self.reaper is None and self.reap_interval and not self.closed:
+            self.reaper = eventlet.spawn(self._reap_forever)
+    def _reap_forever(self):
+        # Ends when the interval is set to 0 or the pool is shut down.
+        while self.reap_interval and not self.closed:
+            eventlet.sleep(self.reap_interval)
+            if not self.closed:
+                self.reap()
+        self.reaper = None
+    def reap(self):
+        """Close the idle and expired free connections, then open new ones
+        up to pool_min_size."""
+        now = time.time()
+        keep, expired = collections.deque(), []
+        extra = self.current_size - self.min_size
+        for connection in self.free_items:
+            if self.max_lifetime and now - connection.created_at > self.max_lifetime:
+                expired.append(connection)
+            elif self.idle_timeout and extra > 0 and now - connection.last_used > self.idle_timeout:
+                expired.append(connection)
+                extra -= 1
+            else:
+                keep.append(connection)
+        self.free_items = keep
+        for connection in expired:
+            self._evict(connection)
+        while self.current_size < self.min_size:
+            self.current_size += 1
+            try:
+                connection = self.create()
+            except Exception:
+                self.current_size -= 1
+                break
+            super(Pool, self).put(connection)
+    def shutdown(self):
+        """Stop the reaper and close the free connections, and the ones in
+        use when they are put back."""
+        self.closed = True
+        if self.reaper is not None:
+            self.reaper.kill()
+            self.reaper = None
+        while self.free_items:
+            self._evict(self.free_items.popleft())
+    def stats(self):
+        """Sizes and counters of the pool; wait_time is the total seconds
+        spent in get()."""
+        stats = dict(self.counters)
+        stats['idle'] = len(self.free_items)
+        stats['in_use'] = self.current_size - len(self.free_items)
+        stats['waiting'] = self.waiting()
+        stats['avg_wait_time'] = stats['wait_time'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
 
 _pool_create_sem = semaphore.Semaphore()
 
@@ -145,56 +1398,479 @@ class ConnectionContext(object):
             return getattr(self.connection, key)
         except Exception as e:
             raise e
-    def _done(self):
-        if self.pooled:
-            self.connection.reset()
-            self.connection_pool.put(self.connection)
+    def _done(self, stats):
+        if not self.pooled:
+            # Closed, and no longer notified of the conf changes.
+            self.connection.shutdown(0)
         else:
-            self.connection.reset()
+            if stats['abandoned']:
+                # The abandoned callbacks still run; closing makes the broker
+                # redeliver their messages now rather than reusing the connection.
+                self.connection.connection.release()
+            # A released connection is not alive, the pool evicts it.
+            self.connection_pool.put(self.connection)
         self.connection = None
+        return stats
     def close(self):
-        self._done()
+        """Reset the connection, see Connection.reset, and put it back in
+        the pool, or close it if it is not pooled."""
+        self._done(self.connection.reset())
+    def shutdown(self, timeout=None):
+        """Drain the connection, see Connection.drain, then put it back in
+        the pool. A connection with deliveries abandoned in flight, or not
+        pooled, is closed instead, so that the broker redelivers them now.
+
+        :return: the counts of Connection.drain
+        """
+        return self._done(self.connection.drain(timeout))
 
 class Connection(object):
     pool = None
     def __init__(self, conf, **kwargs):
         self.conf = conf
+        conf.register_opts(rabbit_opts)
         self.exchange_name = conf.get('exchange_name', 'rabbitmq', default='MR')
+        self.ack_interval = conf.get('ack_interval', 'rabbitmq')
         self.consumers = []
         self.connection = None
         self.consume_thread = None
+        self.acker = None
+        self.publisher = None
+        # The rpc.RpcClient of the connection, see rpc.get_client.
+        self.rpc_client = None
+        # Called by reconnect() once the consumers are re-attached.
+        self.reconnect_callbacks = []
+        self.unconfirmed_lost = 0
+        self.stats = {'reconnects': 0, 'last_recovery_time': 0.0, 'total_recovery_time': 0.0}
+        self.flow = FlowControl(conf.get('max_in_flight', 'rabbitmq'), conf.get('flow_low_watermark', 'rabbitmq'))
+        self.channels = ChannelManager(conf.get('ack_batch_size', 'rabbitmq'), self.ack_interval)
+        # Whether the consumers are cancelled because of self.flow.
+        self.consumers_paused = False
+        # Set by drain() to end the drain loop.
+        self.stopping = False
+        self._resolve_codecs()
+        if hasattr(conf, 'subscribe'):
+            conf.subscribe(self._on_conf_change, 'rabbitmq')
         self.reconnect()
+    def _on_conf_change(self, group, key, old, new):
+        if key in CODEC_OPTIONS:
+            self._resolve_codecs()
+    def _resolve_codecs(self):
+        """Read the options of encode() once, and again when they change."""
+        options = self.conf.snapshot().rabbitmq
+        self.codec = options.codec
+        self.codecs = dict((topic, name) for topic, name in (options.codecs or {}).items() if name)
+        self.compression = options.compression
+        self.compression_threshold = options.compression_threshold
+        missing = set(name for name in [self.codec] + self.codecs.values()
+                      if name and name not in codec.REGISTRY.codecs)
+        if self.compression and self.compression not in codec.REGISTRY.compressors:
+            missing.add(self.compression)
+        if missing - _MISSING_CODECS:
+            _MISSING_CODECS.update(missing)
+            log.lookup('bsl.rabbitmq').warning("Codecs %s are configured but not available, msgpack and "
+                                               "lz4 need their packages installed", ", ".join(sorted(missing)))
     def reconnect(self):
+        """Open a new broker connection and re-attach the existing consumers.
+
+        The consumers keep their callbacks, dispatchers and channel groups;
+        deliveries that were not acked on the old connection are redelivered
+        by the broker. Consumers paused by the flow control are resumed by
+        the drain loop. The reconnect_callbacks are called last.
+        """
         if self.connection:
-            self.reset()
-        self.connection = kombu.Connection(self.conf.get('url', 'rabbitmq'))
+            if self.publisher is not None:
+                self.unconfirmed_lost += len(self.publisher.unconfirmed)
+            try:
+                self.connection.release()
+            except Exception:
+                pass
+        self.publisher = None
+        # Only polling transports such as memory:// use it, 0 keeps kombu's default.
+        transport_options = {}
+        if self.conf.get('polling_interval', 'rabbitmq'):
+            transport_options['polling_interval'] = self.conf.get('polling_interval', 'rabbitmq')
+        self.connection = kombu.Connection(self.conf.get('url', 'rabbitmq'), transport_options=transport_options)
         try:
             self.connection.connect()
-            self.channel = self.connection.channel()
+            self.channels.attach(self.connection)
+            self.channel, self.acker = self.channels.get()
         except Exception as e:
             raise e
-    def create_consumer(self, topic, callback):
-        self.consumers.append(TopicConsumer(self.channel, topic, callback, len(self.consumers), self.exchange_name))
+        self.channel_errors = self.connection.channel_errors
+        self.errors = self.connection.connection_errors + self.connection.channel_errors
+        self.created_at = time.time()
+        self.consumers_paused = self.consume_thread is not None and self.flow.paused
+        for consumer in list(self.consumers):
+            self._attach(consumer)
+        for callback in self.reconnect_callbacks:
+            callback()
+    def _attach(self, consumer):
+        """Re-declare consumer on the channel of its group and resume it.
+
+        A consumer failing so with a channel error max_channel_revivals
+        times in a row, e.g. on a re-declare with other arguments refused
+        with PRECONDITION_FAILED, is closed, so that the others recover.
+        """
+        try:
+            consumer.reconnect(self.channels.get(consumer.channel_group)[0])
+            if self.consume_thread is not None and not self.consumers_paused:
+                consumer.consume()
+        except self.channel_errors as e:
+            consumer.revive_failures += 1
+            if consumer.revive_failures >= self.conf.get('max_channel_revivals', 'rabbitmq'):
+                self.consumers.remove(consumer)
+                metrics.counter('consumers_closed').inc()
+                log.lookup(self.conf.get('failure_logger', 'rabbitmq')).error(
+                    "Closed the consumer of %s after %d failed revivals: %s",
+                    consumer.kwargs.get('name'), consumer.revive_failures, e)
+            # The channel is closed either way, the caller recovers.
+            raise
+        consumer.revive_failures = 0
+    def revive(self):
+        """Reopen the channels closed by a channel-level error and
+        re-attach their consumers, leaving the other channels alone.
+
+        :return: False if no channel was closed, i.e. the connection needs
+                 to recover()
+        """
+        revived = False
+        if self.publisher is not None and not _is_open(self.publisher.channel):
+            self.unconfirmed_lost += len(self.publisher.unconfirmed)
+            self.publisher = None
+            revived = True
+        groups = self.channels.revive()
+        self.channel, self.acker = self.channels.get()
+        for consumer in list(self.consumers):
+            if consumer.channel_group in groups:
+                self._attach(consumer)
+        return revived or bool(groups)
+    def recover(self):
+        """Reconnect with a jittered exponential backoff.
+
+        :return: the seconds it took to recover
+        :raise: the last connection error after reconnect_attempts failures
+        """
+        start = time.time()
+        interval = self.conf.get('reconnect_interval', 'rabbitmq')
+        max_interval = self.conf.get('reconnect_max_interval', 'rabbitmq')
+        attempts = self.conf.get('reconnect_attempts', 'rabbitmq')
+        attempt = 0
+        while True:
+            try:
+                self.reconnect()
+                break
+            except self.errors:
+                attempt += 1
+                if attempts and attempt >= attempts:
+                    raise
+                eventlet.sleep(random.uniform(0, min(max_interval, interval * 2 ** attempt)))
+        elapsed = time.time() - start
+        metrics.counter('reconnects').inc()
+        metrics.histogram('recovery_seconds').observe(elapsed)
+        self.stats['reconnects'] += 1
+        self.stats['last_recovery_time'] = elapsed
+        self.stats['total_recovery_time'] += elapsed
+        return elapsed
+    def recovery_stats(self):
+        """Reconnects and recovery times of the connection, declares of the process."""
+        stats = dict(self.stats)
+        stats['declares'] = DECLARED.declares
+        stats['declares_skipped'] = DECLARED.skipped
+        return stats
+    def create_consumer(self, topic, callback, **kwargs):
+        """Create a TopicConsumer on the connection's channel.
+
+        prefetch_count, prefetch_size and ack_mode default to the values of
+        the [rabbitmq] section and may be overridden per consumer.
+
+        :param channel: the name of the channel group to consume on; the
+                        consumers of a group share a channel, its prefetch
+                        and its acks. By default the topic with
+                        channel_per_consumer set, otherwise the connection's
+                        channel
+
+        :param dispatch: 'inline' runs the callback in the drain loop, 'pool'
+                         hands it to a GreenPool of pool_size greenthreads
+        :param pool_size: defaults to the topic's entry in dispatch_pool_sizes,
+                          then to dispatch_pool_size
+        :param ordered: handle the messages of a routing key in order
+        :param codec: decode the bodies with this codec, see ConsumerBase
+        :param consumer_cls: a TopicConsumer subclass to create instead
+        :param dedup: skip the redeliveries of handled messages, see
+                      ConsumerBase; dedup_key defaults to the option
+        :param failure_policy: 'ack', 'requeue', 'retry' or 'park', see
+                               FailurePolicy; retry_delays and max_retries
+                               default to the options
+        """
+        self._add_consumer(kwargs.pop('consumer_cls', TopicConsumer), topic, callback, kwargs)
+    def create_batch_consumer(self, topic, callback, **kwargs):
+        """Create a BatchTopicConsumer whose callback gets lists of payloads.
+
+        max_batch and max_wait_ms default to the values of the [rabbitmq]
+        section. The other arguments are the ones of create_consumer.
+        """
+        kwargs.setdefault('max_batch', self.conf.get('max_batch', 'rabbitmq'))
+        kwargs.setdefault('max_wait_ms', self.conf.get('max_wait_ms', 'rabbitmq'))
+        self._add_consumer(BatchTopicConsumer, topic, callback, kwargs)
+    def _add_consumer(self, consumer_cls, topic, callback, kwargs):
+        dispatch = kwargs.pop('dispatch', self.conf.get('dispatch', 'rabbitmq'))
+        pool_size = kwargs.pop('pool_size', None)
+        ordered = kwargs.pop('ordered', self.conf.get('dispatch_ordered', 'rabbitmq'))
+        if dispatch not in DISPATCH_MODES:
+            raise ValueError("Unknown dispatch mode: %s" % dispatch)
+        dispatcher = None
+        if dispatch == 'pool':
+            if pool_size is None:
+                sizes = self.conf.get('dispatch_pool_sizes', 'rabbitmq') or {}
+                pool_size = sizes.get(topic) or self.conf.get('dispatch_pool_size', 'rabbitmq')
+            dispatcher = Dispatcher(int(pool_size), ordered)
+        options = {'prefetch_count': self.conf.get('prefetch_count', 'rabbitmq'),
+                   'prefetch_size': self.conf.get('prefetch_size', 'rabbitmq'),
+                   'ack_mode': self.conf.get('ack_mode', 'rabbitmq'),
+                   'dedup_key': self.conf.get('dedup_key', 'rabbitmq')}
+        if kwargs.pop('dedup', self.conf.get('dedup', 'rabbitmq')):
+            options['dedup'] = get_dedup_cache(self.conf)
+        options['failure'] = FailurePolicy(kwargs.pop('failure_policy', self.conf.get('failure_policy', 'rabbitmq')),
+                                           kwargs.pop('retry_delays', self.conf.get('retry_delays', 'rabbitmq')),
+                                           kwargs.pop('max_retries', self.conf.get('max_retries', 'rabbitmq')),
+                                           self.conf.get('failure_logger', 'rabbitmq'),
+                                           self.conf.get('failure_log_interval', 'rabbitmq'))
+        group = kwargs.pop('channel', None) or \
+            (topic if self.conf.get('channel_per_consumer', 'rabbitmq') else DEFAULT_CHANNEL)
+        channel, acker = self.channels.get(group)
+        options.update(kwargs)
+        consumer = consumer_cls(channel, topic, callback, len(self.consumers), self.exchange_name,
+                                acker=acker, dispatcher=dispatcher, flow=self.flow, **options)
+        consumer.channel_group = group
+        self.consumers.append(consumer)
+    def get_publisher(self):
+        """Return the publisher of the connection, opening its channel on first use."""
+        if self.publisher is None:
+            self.publisher = Publisher(self.connection,
+                                       self.conf.get('publish_confirm', 'rabbitmq'),
+                                       self.conf.get('confirm_window', 'rabbitmq'),
+                                       self.conf.get('confirm_timeout', 'rabbitmq'),
+                                       self.is_draining)
+        return self.publisher
+    def encode(self, topic, payload, kwargs):
+        """Encode payload with the codec of topic.
+
+        The codec is the 'codec' keyword argument, then the topic's entry in
+        the codecs option, then the codec option; an empty name leaves the
+        serialization to kombu. Bodies of compression_threshold bytes or more
+        are compressed by the 'compression' argument or option.
+
+        :return: the body and the keyword arguments for kombu.Producer.publish
+        """
+        name = kwargs.pop('codec', None) or self.codecs.get(topic) or self.codec
+        compression = kwargs.pop('compression', self.compression)
+        if not name:
+            return payload, kwargs
+        body, content_type, headers = codec.encode(payload, name, compression, self.compression_threshold)
+        if headers:
+            headers.update(kwargs.get('headers') or {})
+            kwargs['headers'] = headers
+        kwargs['content_type'] = content_type
+        kwargs['content_encoding'] = 'binary'
+        return body, kwargs
+    def publish(self, topic, payload, exchange_name=None, **kwargs):
+        """Publish payload with topic as routing key.
+
+        payload is encoded by encode(). exchange_name defaults to the one of
+        the [rabbitmq] section, '' is the default exchange routing to the
+        queue named topic. Other keyword arguments are passed to
+        kombu.Producer.publish. With publish_confirm enabled, call
+        wait_for_confirms() to be sure the broker has taken the messages.
+        """
+        body, kwargs = self.encode(topic, payload, kwargs)
+        exchange_name = self.exchange_name if exchange_name is None else exchange_name
+        self.get_publisher().publish(exchange_name, topic, body, **kwargs)
+    def publish_many(self, topic, payloads, exchange_name=None, **kwargs):
+        """Publish every payload and wait until all of them are confirmed.
+
+        :return: the number of messages published
+        :raise PublishError: some of the messages were not confirmed
+        """
+        publisher = self.get_publisher()
+        exchange_name = self.exchange_name if exchange_name is None else exchange_name
+        count = 0
+        for payload in payloads:
+            body, options = self.encode(topic, payload, dict(kwargs))
+            publisher.publish(exchange_name, topic, body, **options)
+            count += 1
+        publisher.wait_for_confirms()
+        return count
+    def wait_for_confirms(self, timeout=None):
+        """Wait for the confirms of the publishes so far.
+
+        :raise PublishError: a publish was nacked, timed out or its
+                             connection was lost before the confirm
+        """
+        lost, self.unconfirmed_lost = self.unconfirmed_lost, 0
+        if self.publisher is not None:
+            self.publisher.wait_for_confirms(timeout)
+        if lost:
+            raise PublishError("%d messages were unconfirmed when the connection was lost" % lost)
+    def is_overloaded(self):
+        """Whether max_in_flight deliveries are being handled and the
+        consumers are paused, see FlowControl."""
+        return self.flow.paused
+    def _apply_flow(self):
+        """Cancel the consumers when the flow is paused and consume again
+        once it resumed.
+
+        The broker keeps the queued messages meanwhile. basic.qos cannot
+        stop the deliveries and RabbitMQ does not support channel.flow from
+        the client, so cancelling is the way to stop them.
+        """
+        if self.flow.paused == self.consumers_paused:
+            return
+        self.consumers_paused = self.flow.paused
+        for consumer in self.consumers:
+            if self.consumers_paused and consumer.consuming:
+                consumer.pause()
+            elif not self.consumers_paused and not consumer.consuming:
+                consumer.consume()
     def consume_in_thread(self):
+        # drain_events() wakes up at least every ack_interval seconds, or
+        # sooner if a consumer asks for it, so that batched acks and partial
+        # batches are flushed while the queues are quiet. While the flow is
+        # paused it wakes up every FLOW_POLL_INTERVAL to resume promptly.
+        intervals = [c.tick_interval for c in self.consumers if c.tick_interval]
+        if self.ack_interval:
+            intervals.append(self.ack_interval)
+        # Wake up every second at least, so that drain() ends the loop promptly.
+        timeout = min(intervals) if intervals else 1.0
+        busy = metrics.counter('drain_busy_seconds')
+        idle = metrics.counter('drain_idle_seconds')
+        paused_timeout = min(timeout or FLOW_POLL_INTERVAL, FLOW_POLL_INTERVAL)
         def _start():
+            current = eventlet.getcurrent()
+            self.consumers_paused = False
             for consumer in self.consumers:
                 consumer.consume()
-            while True:
-                self.connection.drain_events()
+            while not self.stopping:
+                start = time.time()
+                handled = sum(consumer.busy_seconds for consumer in self.consumers)
+                try:
+                    self.connection.drain_events(timeout=paused_timeout if self.consumers_paused else timeout)
+                except socket.timeout:
+                    pass
+                except self.errors as e:
+                    if self.consume_thread is not current:
+                        # Abandoned by drain() in a callback, the connection is closed.
+                        return
+                    # Only reconnect if the error was not confined to a channel.
+                    revived = False
+                    if isinstance(e, self.channel_errors):
+                        try:
+                            revived = self.revive()
+                        except self.errors:
+                            revived = False
+                    if not revived:
+                        self.recover()
+                    continue
+                if self.consume_thread is not current:
+                    return
+                for consumer in self.consumers:
+                    consumer.tick()
+                try:
+                    self._apply_flow()
+                except self.errors:
+                    self.recover()
+                    continue
+                # Everything but handling the deliveries is waiting on the socket.
+                handled = sum(consumer.busy_seconds for consumer in self.consumers) - handled
+                busy.inc(handled)
+                idle.inc(max(time.time() - start - handled, 0))
+            # Cancelled here as the loop owns the socket; the deliveries that
+            # arrive until the broker confirms are still handled.
+            for consumer in self.consumers:
+                if consumer.consuming:
+                    consumer.pause()
         greenthread = eventlet.spawn(_start)
         self.consume_thread = greenthread
-    def reset(self):
+    def drain(self, timeout=None):
+        """Stop consuming and let the deliveries in flight finish.
+
+        The drain loop cancels the consumers and exits once it is done with
+        the current delivery, so a callback is never interrupted by it. The
+        dispatched callbacks and the partial batches are then waited for
+        and the acks flushed. Whatever still runs after timeout seconds is
+        abandoned: its messages are left unacked for the broker to redeliver.
+        If the loop itself is still in a callback, the broker connection is
+        closed under it so that they are redelivered now; the callback runs
+        to its end, its ack failing, and the loop exits.
+
+        :param timeout: seconds, shutdown_timeout by default
+        :return: {'drained': the deliveries finished meanwhile,
+                  'abandoned': the deliveries still in flight}
+        """
+        timeout = self.conf.get('shutdown_timeout', 'rabbitmq') if timeout is None else timeout
+        deadline = time.time() + timeout
+        completed = self.flow.completed
+        closed = False
         if self.consume_thread is not None:
-            self.consume_thread.kill()
+            self.stopping = True
+            with eventlet.Timeout(max(deadline - time.time(), 0), False):
+                try:
+                    self.consume_thread.wait()
+                except Exception:
+                    # The loop died of a connection error, nothing to stop.
+                    pass
+            if self.consume_thread.dead or not any(consumer.delivering for consumer in self.consumers):
+                # Waiting on the socket, or done.
+                self.consume_thread.kill()
+            else:
+                self.connection.release()
+                closed = True
+        # Cancel first so that no new deliveries arrive while the callbacks
+        # already dispatched finish and their acks are flushed.
+        for consumer in self.consumers if not closed else ():
             try:
-                self.consume_thread.wait()
-            except greenlet.GreenletExit:
-                pass
-        if len(self.consumers):
-            for consumer in self.consumers:
                 consumer.cancel()
+            except self.errors:
+                pass
+        for consumer in self.consumers:
+            with eventlet.Timeout(max(deadline - time.time(), 0), False):
+                consumer.wait()
+        if not closed:
+            self.channels.flush()
         self.consume_thread = None
         self.consumers = []
+        self.stopping = False
+        stats = {'drained': self.flow.completed - completed, 'abandoned': self.flow.in_flight}
+        metrics.counter('shutdown_drained').inc(stats['drained'])
+        metrics.counter('shutdown_abandoned').inc(stats['abandoned'])
+        return stats
+    def reset(self):
+        """Drain the consumers for reset_timeout seconds, see drain(), and
+        forget them. Short, as the caller is returning the connection to
+        the pool; shutdown() is the one waiting for slow callbacks."""
+        return self.drain(self.conf.get('reset_timeout', 'rabbitmq'))
+    def is_draining(self):
+        """Whether the drain loop runs in another greenthread than the
+        current one, which then leaves reading the socket to it."""
+        return self.consume_thread is not None and eventlet.getcurrent() is not self.consume_thread
+    def is_alive(self):
+        """Cheap liveness probe, no round-trip to the broker."""
+        if self.consume_thread is not None and self.consume_thread.dead:
+            return False
+        return self.connection.connected and getattr(self.channel, 'is_open', True)
+    def shutdown(self, timeout=None):
+        """Drain the consumers and close the broker connection.
+
+        :return: the counts of drain()
+        """
+        stats = self.drain(timeout)
+        self.connection.release()
+        if hasattr(self.conf, 'unsubscribe'):
+            self.conf.unsubscribe(self._on_conf_change)
+        return stats
+    def close(self):
+        """Drain the consumers and close the broker connection."""
+        self.shutdown()
 
 def wait(conn):
     try:
@@ -1,14 +1,343 @@
 # -*- coding: utf-8 -*-
-import logging, os, inspect, json
+import atexit, collections, logging, logging.handlers, os, inspect, json, time
+try:
+    # The writer must be a real thread even after eventlet.monkey_patch(),
+    # so that blocking file I/O never stalls the hub.
+    from eventlet import patcher
+    threading = patcher.original('threading')
+except ImportError:
+    import threading
 LOGGING = None
+FACTORIES = dict()
+LIMITERS = list()
+_WRITER = None
+OVERFLOW_POLICIES = ('block', 'drop', 'sample')
 def setup(path):
-    global LOGGING
+    global LOGGING, FACTORIES
     with open(path) as fp:
         LOGGING = json.load(fp)
+    # What every LogRecord looks up when it is created, whether or not a
+    # format uses it.
+    record = LOGGING.get('record', {})
+    logging.logThreads = int(record.get('threads', True))
+    logging.logProcesses = int(record.get('processes', True))
+    logging.logMultiprocessing = int(record.get('multiprocessing', True))
+    FACTORIES = compile_handlers(LOGGING)
+
+class CachedFormatter(logging.Formatter):
+    """logging.Formatter doing the per-record work once.
+
+    Whether the format uses the time is decided once, asctime is rendered
+    once per second, and a record written by several handlers sharing the
+    formatter is formatted only once.
+    """
+    def __init__(self, fmt=None, datefmt=None):
+        logging.Formatter.__init__(self, fmt, datefmt)
+        self.uses_time = self._fmt.find("%(asctime)") >= 0
+        self.second = (None, None)
+    def usesTime(self):
+        return self.uses_time
+    def formatTime(self, record, datefmt=None):
+        second, stamp = self.second
+        if second != int(record.created):
+            second = int(record.created)
+            stamp = time.strftime(datefmt or "%Y-%m-%d %H:%M:%S", self.converter(record.created))
+            self.second = (second, stamp)
+        if datefmt:
+            return stamp
+        return "%s,%03d" % (stamp, record.msecs)
+    def format(self, record):
+        formatted = record.__dict__.get('_formatted')
+        if formatted is not None and formatted[0] is self:
+            return formatted[1]
+        text = logging.Formatter.format(self, record)
+        record._formatted = (self, text)
+        return text
+
+class Limiter(object):
+    """Thin out the records of a logger before they are built.
+
+    Below 'level', only 1 in 'sample' records is kept, and at most 'rate'
+    records per second pass, in bursts of up to 'burst', by a token bucket.
+    The records left out are counted, and a "suppressed N messages" record
+    is logged at the highest level left out, at most every
+    summary_interval seconds and at exit.
+    """
+    def __init__(self, sample=1, rate=0, burst=None, level=logging.WARNING, summary_interval=60):
+        self.sample = max(int(sample), 1)
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.level = level
+        self.summary_interval = summary_interval
+        self.tokens = self.burst
+        self.filled = time.time()
+        self.seen = 0
+        self.suppressed = 0
+        self.suppressed_level = logging.NOTSET
+        self.summarized = time.time()
+        self.log = None
+    @classmethod
+    def from_config(cls, conf):
+        """Build the Limiter of one entry of "loggers", None if it sets no limit."""
+        if conf.get('sample', 1) <= 1 and not conf.get('rate'):
+            return None
+        return cls(conf.get('sample', 1), conf.get('rate', 0), conf.get('burst'),
+                   getattr(logging, conf.get('limit_level', 'WARNING'), logging.WARNING),
+                   conf.get('summary_interval', 60))
+    def wrap(self, log):
+        """Return log, a Logger._log, guarded by the limiter."""
+        self.log = log
+        def _log(level, *args, **kwargs):
+            if level >= self.level or self.allow(level):
+                log(level, *args, **kwargs)
+        return _log
+    def allow(self, level):
+        now = time.time()
+        allowed = True
+        if self.sample > 1:
+            self.seen += 1
+            allowed = self.seen % self.sample == 1
+        if allowed and self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.filled) * self.rate)
+            self.filled = now
+            allowed = self.tokens >= 1
+            if allowed:
+                self.tokens -= 1
+        if not allowed:
+            self.suppressed += 1
+            self.suppressed_level = max(self.suppressed_level, level)
+        if self.suppressed and now - self.summarized >= self.summary_interval:
+            self.summarize(now)
+        return allowed
+    def summarize(self, now=None):
+        now = now or time.time()
+        suppressed, level = self.suppressed, self.suppressed_level
+        self.suppressed, self.suppressed_level = 0, logging.NOTSET
+        if suppressed and self.log is not None:
+            self.log(level, "suppressed %d messages in the last %ds", (suppressed, now - self.summarized))
+        self.summarized = now
+
+def _no_caller():
+    return "(unknown file)", 0, "(unknown function)"
+
+class HandlerFactory(object):
+    """Build the handler described by one entry of "handlers" in logging.json.
+
+    The class lookup, the constructor introspection and the formatter are
+    done once. Handlers are shared by every logger resolving to the same
+    constructor arguments, i.e. writing to the same sink. With "per_logger"
+    (the default for the "files" handler) the file name is derived from the
+    logger name, so every logger gets a file of its own.
+    """
+    def __init__(self, name, conf, formatters):
+        category = str(conf['class'])
+        module = __import__(category.rsplit(".", 1)[0], fromlist=[category.rsplit(".", 1)[-1],])
+        self.cls = getattr(module, category.rsplit(".", 1)[-1], None)
+        if self.cls is None:
+            raise LookupError("Module is not exist")
+        self.name = name
+        self.args = dict()
+        for arg in inspect.getargspec(self.cls.__init__).args:
+            if arg in conf:
+                self.args[arg] = conf[arg]
+        self.per_logger = conf.get('per_logger', name == "files")
+        self.level = getattr(logging, conf['level'], logging.INFO)
+        self.formatter = formatters[conf['formatter']]
+        self.instances = dict()
+    def get(self, logname):
+        args = self.args
+        if self.per_logger:
+            args = dict(args)
+            args['filename'] = os.path.join(args['filename'].rsplit("/", 1)[0], "_".join(logname.split("."))+".log")
+        key = json.dumps(args, sort_keys=True)
+        if key not in self.instances:
+            instance = self.cls(**args)
+            instance.setFormatter(self.formatter)
+            instance.setLevel(self.level)
+            self.instances[key] = instance
+        return self.instances[key]
+
+def compile_handlers(config):
+    formatters = dict()
+    for name, fm in config['formatters'].items():
+        cls = CachedFormatter if fm.get('cached', True) else logging.Formatter
+        formatters[name] = cls(fm['format'], fm.get('datefmt'))
+    return dict((name, HandlerFactory(name, conf, formatters)) for name, conf in config['handlers'].items())
+
+class AsyncWriter(object):
+    """Background thread emitting the queued records on the real handlers.
+
+    Queuing a record is a deque append; the writer sleeps on an Event only
+    when the deque is empty and is woken up by the next append, and it
+    formats the records itself. They are written in batches of up to
+    batch_size, and each handler is flushed once per batch instead of once
+    per record. When queue_size records are queued, the overflow policy
+    decides: 'block' waits for room, 'drop' discards the record, and
+    'sample' keeps only 1 in sample_rate records below WARNING once the
+    queue is more than sample_watermark full.
+
+    It pays off when the handlers block, e.g. on files synced to disk or on
+    network handlers: the waits move to the writer, which releases the GIL
+    meanwhile. On a plain file the writer's formatting only competes with
+    the caller for the GIL, and synchronous handlers are as fast.
+    """
+    _STOP = object()
+
+    def __init__(self, queue_size=10000, overflow='block', sample_rate=10,
+                 sample_watermark=0.8, batch_size=256):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" % overflow)
+        self.queue = collections.deque()
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.sample_rate = max(int(sample_rate), 1)
+        self.watermark = int(queue_size * sample_watermark)
+        self.batch_size = batch_size
+        self.seen = 0
+        self.dropped = 0
+        # Set by the writer before it checks the queue one last time and
+        # waits, so that an append after that check wakes it up.
+        self.sleeping = False
+        self.wakeup = threading.Event()
+        # Set after every batch, for the callers waiting for room.
+        self.written = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="bsl.log.writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, handlers, record):
+        if len(self.queue) >= self.watermark:
+            if self.overflow == 'drop' and len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                return
+            if self.overflow == 'sample' and record.levelno < logging.WARNING:
+                self.seen += 1
+                if self.seen % self.sample_rate:
+                    self.dropped += 1
+                    return
+            while self.overflow != 'drop' and len(self.queue) >= self.queue_size and self.thread.is_alive():
+                self.written.clear()
+                # Checked again as the writer may have set it before the clear.
+                if len(self.queue) >= self.queue_size:
+                    self.written.wait(0.1)
+        self._append((handlers, record))
+
+    def _append(self, item):
+        self.queue.append(item)
+        if self.sleeping:
+            self.wakeup.set()
+
+    def flush(self, timeout=None):
+        """Block until every record queued so far is written."""
+        if self.thread.is_alive():
+            done = threading.Event()
+            self._append(done)
+            done.wait(timeout)
+
+    def stop(self, timeout=5):
+        if self.thread.is_alive():
+            self._append(self._STOP)
+            self.thread.join(timeout)
+
+    def _run(self):
+        queue = self.queue
+        while True:
+            if not queue:
+                self.sleeping = True
+                self.wakeup.clear()
+                if not queue:
+                    self.wakeup.wait()
+                self.sleeping = False
+                continue
+            batch = []
+            while queue and len(batch) < self.batch_size:
+                batch.append(queue.popleft())
+            self._write([item for item in batch if type(item) is tuple])
+            self.written.set()
+            for item in batch:
+                if item is self._STOP:
+                    return
+                if type(item) is not tuple:
+                    item.set()
+
+    def _write(self, batch):
+        touched = set()
+        for handlers, record in batch:
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    _emit(handler, record)
+                    touched.add(handler)
+        for handler in touched:
+            try:
+                handler.flush()
+            except Exception:
+                pass
+
+def _emit(handler, record):
+    """Handler.handle() without the per-record flush of StreamHandler."""
+    if not isinstance(handler, logging.StreamHandler):
+        handler.handle(record)
+        return
+    if not handler.filter(record):
+        return
+    handler.acquire()
+    try:
+        if isinstance(handler, logging.handlers.BaseRotatingHandler) and handler.shouldRollover(record):
+            handler.doRollover()
+        if handler.stream is None:
+            handler.stream = handler._open()
+        msg = handler.format(record) + "\n"
+        try:
+            handler.stream.write(msg)
+        except UnicodeError:
+            handler.stream.write(msg.encode("UTF-8"))
+    except Exception:
+        handler.handleError(record)
+    finally:
+        handler.release()
+
+class AsyncHandler(logging.Handler):
+    """Queue the records for the AsyncWriter instead of writing them.
+
+    The record is formatted by the writer, with the arguments as they are
+    then: do not log objects that are modified right after.
+    """
+    def __init__(self, writer, handlers):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.handlers = tuple(handlers)
+    def handle(self, record):
+        # No handler lock, the writer's queue is thread-safe.
+        if self.filters and not self.filter(record):
+            return False
+        self.writer.put(self.handlers, record)
+        return True
+    def emit(self, record):
+        self.writer.put(self.handlers, record)
+
+def get_writer():
+    """Return the AsyncWriter configured by the "async" section, starting it on first use."""
+    global _WRITER
+    if _WRITER is None:
+        conf = dict(LOGGING.get('async', {}))
+        conf.pop('enabled', None)
+        _WRITER = AsyncWriter(**conf)
+    return _WRITER
+
+@atexit.register
+def shutdown():
+    """Log the pending summaries and write out the queued records, called at exit."""
+    for limiter in LIMITERS:
+        limiter.summarize()
+    if _WRITER is not None:
+        _WRITER.stop()
 
 def dec(fn):
     if 'LOGGER' not in fn.__dict__:
         fn.__dict__["LOGGER"] = dict()
+    # A real lock: nothing in fn yields to the eventlet hub, so greenthreads
+    # never contend for it, while OS threads are serialised.
+    lock = threading.RLock()
     def wrapped(*args, **kwargs):
         if "logname" in kwargs and kwargs["logname"] in fn.__dict__["LOGGER"]:
             return fn.__dict__["LOGGER"][kwargs["logname"]]
@@ -16,38 +345,45 @@ def dec(fn):
             return fn.__dict__["LOGGER"][args[0]]
         else:
             name = kwargs["logname"] if "logname" in kwargs else args[0]
-            fn.__dict__["LOGGER"][name] = fn(*args, **kwargs)
+            with lock:
+                if name not in fn.__dict__["LOGGER"]:
+                    fn.__dict__["LOGGER"][name] = fn(*args, **kwargs)
             return fn.__dict__["LOGGER"][name]
     return wrapped
 
+def lookup(logname):
+    """Return the logger logname of getLogger, or the one of logging if
+    bsl.log is not set up or does not know it."""
+    try:
+        return getLogger(logname)
+    except (LookupError, TypeError):
+        return logging.getLogger(logname)
+
 @dec
 def getLogger(logname="indoor"):
     if logname not in LOGGING['loggers']:
         raise LookupError(logname + " is not exist")
     logger = logging.getLogger(logname)
+    handlers = []
     for handler in LOGGING['loggers'][logname]['handlers']:
-        if handler not in LOGGING['handlers']:
+        if handler not in FACTORIES:
             continue
-        category = LOGGING['handlers'][handler]['class']
-        fm = LOGGING['handlers'][handler]['formatter']
-        level = getattr(logging, LOGGING['handlers'][handler]['level'], logging.INFO)
-        module = __import__(str(category).rsplit(".", 1)[0], fromlist=[str(category).rsplit(".", 1)[-1],])
-        cls = getattr(module, category.rsplit(".", 1)[-1])
-        if cls is None:
-            raise LookupError("Module is not exist")
-
-        args = dict()
-        for arg in inspect.getargspec(cls.__dict__["__init__"]).args:
-            if arg in LOGGING['handlers'][handler]:
-                args[arg] = LOGGING['handlers'][handler][arg]
-        if handler == "files":
-            args['filename'] = os.path.join(args['filename'].rsplit("/", 1)[0], "_".join(logname.split("."))+".log")
-        instance = cls(**args)
-        instance.setFormatter(logging.Formatter(LOGGING['formatters'][fm]['format']))
-        instance.setLevel(level)
-        logger.addHandler(instance)
+        handlers.append(FACTORIES[handler].get(logname))
+    if LOGGING.get('async', {}).get('enabled', False):
+        logger.addHandler(AsyncHandler(get_writer(), handlers))
+    else:
+        for instance in handlers:
+            logger.addHandler(instance)
     logger.setLevel(getattr(logging, LOGGING['loggers'][logname]['level'], logging.INFO))
     logger.propagate = LOGGING['loggers'][logname]['propagate']
+    # Instance attributes shadowing the Logger methods, so that the records
+    # are not even built when they are limited, nor their caller looked up.
+    if not LOGGING['loggers'][logname].get('caller_info', True):
+        logger.findCaller = _no_caller
+    limiter = Limiter.from_config(LOGGING['loggers'][logname])
+    if limiter is not None:
+        logger._log = limiter.wrap(logger._log)
+        LIMITERS.append(limiter)
     return logger
 
 
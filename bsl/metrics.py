@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import bisect, json, logging
+
+# Upper bounds in seconds, the last bucket counts everything above.
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram(object):
+    """Fixed-bucket histogram, observe() is a bisect and two additions."""
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile, None if
+        it is above the last bucket."""
+        if not self.count:
+            return 0.0
+        rank = q / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else None
+        return None
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+                'p50': self.percentile(50), 'p99': self.percentile(99)}
+
+
+class Registry(object):
+    """In-process registry of counters, gauges and histograms.
+
+    Instruments are keyed by name and labels. Looking one up costs a dict
+    access, so hot code looks its instruments up once and keeps them.
+    Collectors are functions returning a dict, called by snapshot() for
+    values that are cheaper to read on demand than to record.
+    """
+
+    def __init__(self):
+        self.instruments = {}
+        self.collectors = {}
+
+    def _get(self, cls, name, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        instrument = self.instruments.get(key)
+        if instrument is None:
+            instrument = self.instruments[key] = cls(*args)
+        return instrument
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, labels, buckets)
+
+    def collect(self, name, func):
+        """Add func() to the snapshot under name; func=None removes it."""
+        if func is None:
+            self.collectors.pop(name, None)
+        else:
+            self.collectors[name] = func
+
+    def snapshot(self):
+        """
+        :return: {name: [{'labels': {...}, 'value': ...}, ...]}
+        """
+        snapshot = {}
+        for (name, labels), instrument in sorted(self.instruments.items()):
+            snapshot.setdefault(name, []).append({'labels': dict(labels), 'value': instrument.snapshot()})
+        for name, func in self.collectors.items():
+            try:
+                snapshot[name] = [{'labels': {}, 'value': func()}]
+            except Exception:
+                pass
+        return snapshot
+
+    def dump_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def dump_text(self):
+        """One 'name{labels} value' line per counter and gauge, count, sum
+        and percentiles for histograms."""
+        lines = []
+        for name, series in sorted(self.snapshot().items()):
+            for serie in series:
+                labels = ','.join('%s=%s' % item for item in sorted(serie['labels'].items()))
+                prefix = '%s{%s}' % (name, labels) if labels else name
+                value = serie['value']
+                if isinstance(value, dict):
+                    for key in sorted(value):
+                        if key != 'buckets':
+                            lines.append('%s.%s %s' % (prefix, key, value[key]))
+                else:
+                    lines.append('%s %s' % (prefix, value))
+        return '\n'.join(lines)
+
+    def reset(self):
+        self.instruments.clear()
+
+
+def log_every(interval, logger=None, registry=None):
+    """Log the snapshot as one JSON line every interval seconds.
+
+    :return: the greenthread, kill it to stop
+    """
+    import eventlet
+    logger = logger or logging.getLogger('bsl.metrics')
+    registry = registry or REGISTRY
+
+    def _run():
+        while True:
+            eventlet.sleep(interval)
+            logger.info("metrics %s", registry.dump_json())
+    return eventlet.spawn(_run)
+
+
+def serve(port, host='127.0.0.1', registry=None):
+    """Serve the snapshot on http://host:port/, as JSON on /metrics.json
+    and as text on any other path. Bound to localhost by default.
+
+    :return: the server greenthread, kill it to stop
+    """
+    import eventlet
+    from eventlet import wsgi
+    registry = registry or REGISTRY
+
+    def _app(environ, start_response):
+        if environ.get('PATH_INFO', '').endswith('.json'):
+            body, content_type = registry.dump_json(), 'application/json'
+        else:
+            body, content_type = registry.dump_text() + '\n', 'text/plain'
+        start_response('200 OK', [('Content-Type', content_type), ('Content-Length', str(len(body)))])
+        return [body]
+    sock = eventlet.listen((host, port))
+    return eventlet.spawn(wsgi.server, sock, _app, log_output=False)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+snapshot = REGISTRY.snapshot
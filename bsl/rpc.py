@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+import itertools, socket, time, uuid
+import kombu, eventlet
+from eventlet import event, semaphore
+from configure import BoolOpt, FloatOpt
+import codec, impl_rabbitmq, metrics
+
+rpc_opts = [FloatOpt('rpc_timeout', 'rabbitmq', default=30),
+            BoolOpt('rpc_direct_reply_to', 'rabbitmq', default=True)]
+
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+# Seconds a waiter sleeps before it checks whether it can read the socket itself.
+POLL_INTERVAL = 0.01
+
+
+class RpcError(Exception):
+    pass
+
+
+class RpcTimeout(RpcError):
+    """Raised when no reply arrived in time."""
+
+
+class RemoteError(RpcError):
+    """The method raised on the server.
+
+    exc_type and value are the name and the message of the exception.
+    """
+
+    def __init__(self, exc_type, value):
+        super(RemoteError, self).__init__("%s: %s" % (exc_type, value))
+        self.exc_type = exc_type
+        self.value = value
+
+
+def _decode(message):
+    if not codec.REGISTRY.knows(message.content_type, message.headers):
+        return message.payload
+    return codec.decode(message.body, message.content_type, message.headers)
+
+
+def _result(reply):
+    error = reply.get('error')
+    if error is not None:
+        return RemoteError(error.get('type'), error.get('message'))
+    return reply.get('result')
+
+
+class Future(object):
+    """The pending reply of a call, or the replies of a multicall."""
+
+    def __init__(self, client, correlation_id, deadline, multi=False, expect=None):
+        self.client = client
+        self.correlation_id = correlation_id
+        self.deadline = deadline
+        self.multi = multi
+        self.expect = expect
+        self.replies = []
+        self.error = None
+        self.event = event.Event()
+
+    def done(self):
+        if self.error is not None:
+            return True
+        if self.multi:
+            return bool(self.expect) and len(self.replies) >= self.expect
+        return bool(self.replies)
+
+    def set(self, reply):
+        self.replies.append(reply)
+        if self.done() and not self.event.ready():
+            self.event.send()
+
+    def fail(self, error):
+        self.error = error
+        if not self.event.ready():
+            self.event.send()
+
+    def wait(self, timeout=None):
+        """Wait for the reply.
+
+        A call returns the result of the method and raises RemoteError if
+        it raised, or RpcTimeout. A multicall returns the results received
+        until timeout, or until 'expect' of them arrived, with a RemoteError
+        in place of the result of each server that failed.
+
+        :param timeout: seconds, by default what is left of the timeout of the call
+        """
+        deadline = self.deadline if timeout is None else time.time() + timeout
+        self.client.wait(self, deadline)
+        if self.error is not None:
+            raise self.error
+        if self.multi:
+            return [_result(reply) for reply in self.replies]
+        if not self.replies:
+            raise RpcTimeout("No reply to %s in time" % self.correlation_id)
+        result = _result(self.replies[0])
+        if isinstance(result, RemoteError):
+            raise result
+        return result
+
+
+class RpcClient(object):
+    """Call methods of an RpcServer through one Connection.
+
+    The replies come back on a single consumer of RabbitMQ's direct
+    reply-to pseudo-queue, opened on a channel of the client's own together
+    with the producer, so a call costs one publish and no declare. On other
+    transports, e.g. memory://, or with rpc_direct_reply_to disabled, an
+    exclusive reply queue is declared once for the client instead. Replies
+    are matched to their Future by correlation id.
+
+    While the connection runs consume_in_thread(), its drain loop delivers
+    the replies; otherwise, or when the call is made by an inline callback
+    of that loop, the waiting greenthread reads the socket itself.
+    Use get_client() to share one client per pooled connection, and wait
+    for the futures before the connection goes back to the pool. When the
+    connection reconnects, the pending calls fail with RpcError.
+    """
+
+    def __init__(self, connection, timeout=None, direct_reply_to=None):
+        """
+        :param connection: the impl_rabbitmq.Connection to call through
+        :param timeout: default seconds to wait for a reply, rpc_timeout by default
+        :param direct_reply_to: use amq.rabbitmq.reply-to on AMQP brokers,
+                                rpc_direct_reply_to by default
+        """
+        connection.conf.register_opts(rpc_opts)
+        self.connection = connection
+        self.timeout = timeout or connection.conf.get('rpc_timeout', 'rabbitmq')
+        if direct_reply_to is None:
+            direct_reply_to = connection.conf.get('rpc_direct_reply_to', 'rabbitmq')
+        self.direct_reply_to = direct_reply_to
+        self.id = uuid.uuid4().hex
+        self.ids = itertools.count()
+        self.pending = {}
+        self.lock = semaphore.Semaphore()
+        self.kombu_connection = None
+        connection.reconnect_callbacks.append(self._on_reconnect)
+        self.calls = metrics.counter('rpc_calls')
+        self.timeouts = metrics.counter('rpc_timeouts')
+        self.latency = metrics.histogram('rpc_call_seconds')
+
+    def _open(self):
+        """(Re)open the channel and the reply consumer if the connection
+        reconnected since they were opened."""
+        transport = self.connection.connection
+        if transport is self.kombu_connection:
+            return
+        for future in self.pending.values():
+            future.fail(RpcError("Connection lost before the reply to %s" % future.correlation_id))
+        self.pending = {}
+        self.channel = transport.channel()
+        if self.direct_reply_to and transport.transport.driver_type == 'amqp':
+            self.reply_to = DIRECT_REPLY_TO
+            queue = kombu.Queue(DIRECT_REPLY_TO, channel=self.channel)
+        else:
+            self.reply_to = 'bsl.reply.%s' % self.id
+            queue = kombu.Queue(self.reply_to, routing_key=self.reply_to, channel=self.channel,
+                                durable=False, exclusive=True, auto_delete=True)
+            queue.declare()
+        queue.consume(consumer_tag='bsl.reply.%s' % self.id, callback=self._on_reply, no_ack=True)
+        self.producers = {}
+        self.kombu_connection = transport
+
+    def _on_reconnect(self):
+        # Fail the calls in flight now rather than at their timeout.
+        if self.kombu_connection is not None:
+            self._open()
+
+    def _on_reply(self, raw_message):
+        message = self.channel.message_to_python(raw_message)
+        future = self.pending.get(message.properties.get('correlation_id'))
+        if future is None:
+            # Its caller gave up waiting.
+            return
+        future.set(_decode(message))
+        if not future.multi:
+            del self.pending[future.correlation_id]
+
+    def _publish(self, topic, payload, reply=None, exchange_name=None, **kwargs):
+        self._open()
+        exchange_name = self.connection.exchange_name if exchange_name is None else exchange_name
+        producer = self.producers.get(exchange_name)
+        if producer is None:
+            exchange = kombu.Exchange(name=exchange_name, type='topic', durable=True, auto_delete=False)
+            producer = self.producers[exchange_name] = kombu.Producer(self.channel, exchange)
+        future = None
+        if reply is not None:
+            correlation_id = '%s.%d' % (self.id, next(self.ids))
+            deadline = time.time() + reply['timeout']
+            future = Future(self, correlation_id, deadline, reply.get('multi', False), reply.get('expect'))
+            self.pending[correlation_id] = future
+            kwargs.update(reply_to=self.reply_to, correlation_id=correlation_id,
+                          expiration=reply['timeout'])
+        body, kwargs = self.connection.encode(topic, payload, kwargs)
+        producer.publish(body, routing_key=topic, **kwargs)
+        self.calls.inc()
+        return future
+
+    def call_async(self, topic, method, timeout=None, **kwargs):
+        """Call method on one of the servers of topic.
+
+        :return: a Future, its wait() returns the result
+        """
+        return self._publish(topic, {'method': method, 'args': kwargs},
+                             {'timeout': timeout or self.timeout})
+
+    def call(self, topic, method, timeout=None, **kwargs):
+        """Call method with kwargs on one of the servers of topic and wait
+        for its result.
+
+        :raise RemoteError: the method raised on the server
+        :raise RpcTimeout: no reply in timeout seconds
+        """
+        start = time.time()
+        result = self.call_async(topic, method, timeout, **kwargs).wait()
+        self.latency.observe(time.time() - start)
+        return result
+
+    def cast(self, topic, method, **kwargs):
+        """Call method on one of the servers of topic without waiting for,
+        nor getting, a reply."""
+        self._publish(topic, {'method': method, 'args': kwargs})
+
+    def multicall(self, topic, method, timeout=None, expect=None, **kwargs):
+        """Call method on every server of topic started with fanout.
+
+        :param expect: return as soon as this many replies arrived
+        :return: the results received in timeout seconds, see Future.wait
+        """
+        future = self._publish(RpcServer.fanout_topic(topic), {'method': method, 'args': kwargs},
+                               {'timeout': timeout or self.timeout, 'multi': True, 'expect': expect})
+        try:
+            return future.wait()
+        finally:
+            self.pending.pop(future.correlation_id, None)
+
+    def wait(self, future, deadline):
+        """Wait until future is done or deadline passed."""
+        while not future.done():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                # A shorter wait() leaves the call pending until its own timeout.
+                if deadline >= future.deadline and self.pending.pop(future.correlation_id, None) \
+                        and not future.multi:
+                    self.timeouts.inc()
+                return
+            if self.connection.is_draining():
+                # The drain loop reads the socket and calls _on_reply; unless
+                # this is an inline callback of that loop, waiting on itself.
+                with eventlet.Timeout(remaining, False):
+                    future.event.wait()
+            elif self.lock.acquire(blocking=False):
+                try:
+                    self.connection.connection.drain_events(timeout=remaining)
+                except socket.timeout:
+                    pass
+                finally:
+                    self.lock.release()
+            else:
+                # Another waiter reads the socket; take over if it is done.
+                with eventlet.Timeout(min(remaining, POLL_INTERVAL), False):
+                    future.event.wait()
+
+
+def get_client(connection):
+    """Return the RpcClient of connection, a Connection or ConnectionContext."""
+    if isinstance(connection, impl_rabbitmq.ConnectionContext):
+        connection = connection.connection
+    if connection.rpc_client is None:
+        connection.rpc_client = RpcClient(connection)
+    return connection.rpc_client
+
+
+class RpcConsumer(impl_rabbitmq.TopicConsumer):
+    """TopicConsumer handing (payload, message) to the callback, so that
+    the server sees reply_to and correlation_id."""
+
+    def decode(self, message):
+        return super(RpcConsumer, self).decode(message), message
+
+
+class RpcServer(object):
+    """Serve the methods of an endpoint to the RpcClients calling topic.
+
+    The calls are load-balanced over the servers sharing the topic's queue.
+    With fanout, every server also consumes an exclusive queue bound to
+    '<topic>.fanout', on which multicall() reaches all of them. The methods
+    run in the consumer callbacks, so dispatch='pool' and the other
+    create_consumer arguments apply.
+    """
+
+    def __init__(self, connection, topic, endpoint, fanout=True, **kwargs):
+        """
+        :param connection: the impl_rabbitmq.Connection to serve on
+        :param endpoint: a dict of callables by method name, or an object
+                         whose public methods are served
+        :param kwargs: passed to Connection.create_consumer
+        """
+        self.connection = connection
+        self.topic = topic
+        self.endpoint = endpoint
+        self.fanout = fanout
+        self.kwargs = kwargs
+        self.id = uuid.uuid4().hex
+        self.requests = metrics.counter('rpc_requests', topic=topic)
+        self.errors = metrics.counter('rpc_errors', topic=topic)
+
+    @staticmethod
+    def fanout_topic(topic):
+        return '%s.fanout' % topic
+
+    def lookup(self, method):
+        if isinstance(self.endpoint, dict):
+            return self.endpoint.get(method)
+        if method.startswith('_'):
+            return None
+        return getattr(self.endpoint, method, None)
+
+    def start(self):
+        """Consume the requests in the connection's drain loop."""
+        self.connection.create_consumer(self.topic, self._on_request, consumer_cls=RpcConsumer, **self.kwargs)
+        if self.fanout:
+            self.connection.create_consumer(self.fanout_topic(self.topic), self._on_request,
+                                            consumer_cls=RpcConsumer,
+                                            name='%s.%s' % (self.fanout_topic(self.topic), self.id),
+                                            durable=False, exclusive=True, auto_delete=True,
+                                            exchange_durable=True, exchange_auto_delete=False, **self.kwargs)
+        self.connection.consume_in_thread()
+
+    def stop(self, timeout=None):
+        """Stop consuming once the running calls have replied.
+
+        :param timeout: seconds to wait for them, see Connection.drain
+        :return: the counts of Connection.drain
+        """
+        return self.connection.drain(timeout)
+
+    def _on_request(self, request):
+        payload, message = request
+        self.requests.inc()
+        try:
+            func = self.lookup(payload['method'])
+            if func is None:
+                raise AttributeError("No such method: %s" % payload['method'])
+            reply = {'result': func(**(payload.get('args') or {}))}
+        except Exception as e:
+            self.errors.inc()
+            reply = {'error': {'type': type(e).__name__, 'message': str(e)}}
+        reply_to = message.properties.get('reply_to')
+        if reply_to:
+            self.connection.publish(reply_to, reply, exchange_name='', delivery_mode=1,
+                                    correlation_id=message.properties.get('correlation_id'))
+
+
+if __name__ == "__main__":
+    eventlet.monkey_patch()
+    from configure import CONF
+    path = "../etc/bsl.conf"
+    CONF.setup(path)
+    server = RpcServer(impl_rabbitmq.Connection(CONF), 'MRrpc', {'echo': lambda **kwargs: kwargs})
+    server.start()
+    client = get_client(impl_rabbitmq.Connection(CONF))
+    print client.call('MRrpc', 'echo', text='hello')
+    print client.multicall('MRrpc', 'echo', timeout=1, text='hello')
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+import errno, multiprocessing, os, select, signal, time
+import eventlet
+from eventlet import hubs
+from configure import FloatOpt, IntOpt
+import impl_rabbitmq, log
+
+service_opts = [IntOpt('workers', 'rabbitmq', default=0),
+                FloatOpt('worker_heartbeat_interval', 'rabbitmq', default=1),
+                FloatOpt('worker_heartbeat_timeout', 'rabbitmq', default=30),
+                FloatOpt('worker_graceful_timeout', 'rabbitmq', default=30)]
+
+
+class Worker(object):
+    """Consume the registered topics on a Connection of its own.
+
+    run() blocks until stop() is called or the drain loop dies, then drains
+    the consumers and closes the connection. The worker does not fork, so
+    it can also be run in-process, e.g. against the memory:// transport.
+    """
+
+    def __init__(self, conf, registrations, connection_cls=impl_rabbitmq.Connection,
+                 heartbeat=None, heartbeat_interval=1, shutdown_timeout=None):
+        """
+        :param conf: the ConfigOpts the Connection is built from
+        :param registrations: (method, topic, callback, kwargs) tuples, method
+                              being a create_*consumer method of the Connection
+        :param heartbeat: called every heartbeat_interval seconds while the
+                          worker is healthy
+        :param shutdown_timeout: seconds given to the deliveries in flight
+                                 on stop, shutdown_timeout by default
+        """
+        self.conf = conf
+        self.registrations = registrations
+        self.connection_cls = connection_cls
+        self.heartbeat = heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        self.shutdown_timeout = shutdown_timeout
+        self.connection = None
+        self.running = False
+        self.stats = None
+
+    def start(self):
+        self.connection = self.connection_cls(self.conf)
+        for method, topic, callback, kwargs in self.registrations:
+            getattr(self.connection, method)(topic, callback, **dict(kwargs))
+        self.connection.consume_in_thread()
+        self.running = True
+
+    def run(self):
+        """Run until stopped.
+
+        :return: 0 after a graceful stop, 1 if the drain loop died
+        """
+        self.start()
+        while self.running and not self.connection.consume_thread.dead:
+            if self.heartbeat:
+                self.heartbeat()
+            eventlet.sleep(self.heartbeat_interval)
+        if self.connection.consume_thread.dead:
+            # The broker connection is unusable, let the broker redeliver.
+            return 1
+        self.stats = self.connection.shutdown(self.shutdown_timeout)
+        log.lookup('bsl.service').info("worker %d stopped, %d deliveries drained, %d abandoned",
+                                       os.getpid(), self.stats['drained'], self.stats['abandoned'])
+        return 0
+
+    def stop(self):
+        self.running = False
+
+    def handle_signals(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        """Stop gracefully on signals, for an entry point running the
+        worker in the main process."""
+        for signo in signals:
+            signal.signal(signo, lambda signo, frame: self.stop())
+
+
+class Supervisor(object):
+    """Fork worker processes consuming the same topics and keep them alive.
+
+    Every worker builds its own Connection from the shared conf. A worker
+    that exits or stops sending heartbeats for worker_heartbeat_timeout
+    seconds is replaced, with a growing delay if it keeps dying right after
+    start. SIGTERM and SIGINT are forwarded to the workers, which drain
+    their consumers for up to shutdown_timeout seconds, and those still
+    alive after worker_graceful_timeout are killed, so the latter should
+    be the longer.
+
+    Callbacks run in the workers, so they must be registered before run().
+    Use eventlet.monkey_patch() early in the entry point, as the workers
+    run the drain loop in a greenthread.
+    """
+
+    def __init__(self, conf, workers=None, connection_cls=impl_rabbitmq.Connection):
+        conf.register_opts(service_opts)
+        self.conf = conf
+        self.workers = workers or conf.get('workers', 'rabbitmq') or multiprocessing.cpu_count()
+        self.connection_cls = connection_cls
+        self.heartbeat_interval = conf.get('worker_heartbeat_interval', 'rabbitmq')
+        self.heartbeat_timeout = conf.get('worker_heartbeat_timeout', 'rabbitmq')
+        self.graceful_timeout = conf.get('worker_graceful_timeout', 'rabbitmq')
+        self.registrations = []
+        self.children = {}
+        self.running = False
+        self.deadline = None
+        self.restarts = 0
+
+    def register(self, topic, callback, **kwargs):
+        """Consume topic in every worker, see Connection.create_consumer."""
+        self.registrations.append(('create_consumer', topic, callback, kwargs))
+
+    def register_batch(self, topic, callback, **kwargs):
+        """Consume topic in batches in every worker, see Connection.create_batch_consumer."""
+        self.registrations.append(('create_batch_consumer', topic, callback, kwargs))
+
+    def run(self):
+        """Start the workers and supervise them until they all stopped."""
+        self.running = True
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        for index in range(self.workers):
+            self._spawn(index)
+        while self.children:
+            self._poll()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.deadline = time.time() + self.graceful_timeout
+        for pid in self.children:
+            self._kill(pid, signal.SIGTERM)
+
+    def _on_signal(self, signo, frame):
+        self.stop()
+
+    def _spawn(self, index, delay=0):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # The parent's hub, its timers and greenthreads, e.g. a metrics
+            # server or a ConfigWatcher, must not run in the worker too.
+            hubs.use_hub()
+            os.close(rfd)
+            code = 1
+            try:
+                code = self._child(wfd, delay)
+            finally:
+                os._exit(code)
+        os.close(wfd)
+        self.children[pid] = {'index': index, 'fd': rfd, 'started': time.time(),
+                              'seen': time.time(), 'delay': delay}
+
+    def _child(self, wfd, delay):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Inherited from the supervisor; nothing to drain before the worker runs.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if delay:
+            time.sleep(delay)
+
+        def _heartbeat():
+            try:
+                os.write(wfd, '.')
+            except OSError:
+                worker.stop()
+
+        worker = Worker(self.conf, self.registrations, self.connection_cls,
+                        _heartbeat, self.heartbeat_interval)
+        worker.handle_signals((signal.SIGTERM,))
+        return worker.run()
+
+    def _poll(self):
+        fds = dict((child['fd'], pid) for pid, child in self.children.items() if child['fd'] is not None)
+        try:
+            readable = select.select(list(fds), [], [], self.heartbeat_interval)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        now = time.time()
+        for fd in readable:
+            try:
+                data = os.read(fd, 512)
+            except OSError:
+                continue
+            child = self.children[fds[fd]]
+            if not data:
+                # The worker exited, _reap() replaces it.
+                os.close(fd)
+                child['fd'] = None
+                continue
+            child['seen'] = now
+        self._reap()
+        for pid, child in self.children.items():
+            if not self.running:
+                if now > self.deadline:
+                    self._kill(pid, signal.SIGKILL)
+            elif now - child['seen'] > self.heartbeat_timeout + child['delay']:
+                # Hung, e.g. a callback that never yields to the hub.
+                self._kill(pid, signal.SIGKILL)
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if pid == 0:
+                return
+            child = self.children.pop(pid, None)
+            if child is None:
+                continue
+            if child['fd'] is not None:
+                os.close(child['fd'])
+            if self.running:
+                self.restarts += 1
+                # Back off when the worker dies right after it started.
+                delay = 0
+                if time.time() - child['started'] < self.heartbeat_timeout:
+                    delay = min(max(child['delay'] * 2, 1), 60)
+                self._spawn(child['index'], delay)
+
+    def _kill(self, pid, signo):
+        try:
+            os.kill(pid, signo)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+
+if __name__ == "__main__":
+    eventlet.monkey_patch()
+    from configure import CONF
+    path = "../etc/bsl.conf"
+    CONF.setup(path)
+    supervisor = Supervisor(CONF)
+    supervisor.register('MRtest', impl_rabbitmq.callback)
+    supervisor.run()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the messaging, configuration and logging hot paths.
+
+Runs offline against kombu's memory:// transport, or against a local broker
+given with --url, and prints one JSON document so that the numbers of two
+versions can be compared:
+
+    python benchmark.py -n 20000 -o before.json
+    python benchmark.py -n 20000 consume config
+"""
+import eventlet
+eventlet.monkey_patch()
+import json, logging, optparse, os, platform, shutil, subprocess, sys, tempfile, time, uuid
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bsl import configure, impl_rabbitmq, log
+from bsl.configure import BoolOpt, DictOpt, FloatOpt, IntOpt, ListOpt, StrOpt
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(int(q / 100.0 * len(samples)), len(samples) - 1)]
+    return {'p50': pick(50), 'p90': pick(90), 'p99': pick(99), 'max': samples[-1]}
+
+
+def make_conf(url, **options):
+    """A ConfigOpts reading a temporary [rabbitmq] section."""
+    options.setdefault('url', url)
+    options.setdefault('polling_interval', 0.001)
+    fd, path = tempfile.mkstemp(suffix='.conf')
+    with os.fdopen(fd, 'w') as fp:
+        fp.write('[default]\n[rabbitmq]\n')
+        for key, value in options.items():
+            fp.write('%s=%s\n' % (key, value))
+    conf = configure.ConfigOpts(env_prefix=None)
+    conf.setup(path)
+    os.remove(path)
+    return conf
+
+
+def wait_for(predicate, timeout):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        eventlet.sleep(0.001)
+
+
+def bench_publish(opts):
+    """Publish throughput, one message at a time and with publish_many."""
+    results = {}
+    for confirm in (False, True):
+        conf = make_conf(opts.url, publish_confirm=confirm)
+        conn = impl_rabbitmq.Connection(conf)
+        topic = 'bench.publish.%s' % uuid.uuid4().hex
+        start = time.time()
+        for i in range(opts.count):
+            conn.publish(topic, i)
+        conn.wait_for_confirms()
+        single = time.time() - start
+        start = time.time()
+        conn.publish_many(topic, range(opts.count))
+        many = time.time() - start
+        conn.close()
+        results['confirm' if confirm else 'no_confirm'] = {
+            'publish_msgs_per_sec': opts.count / single,
+            'publish_many_msgs_per_sec': opts.count / many}
+    return results
+
+
+def _consume(opts, create='create_consumer', **kwargs):
+    conf = make_conf(opts.url, **kwargs.pop('conf', {}))
+    conn = impl_rabbitmq.Connection(conf)
+    topic = 'bench.consume.%s' % uuid.uuid4().hex
+    latencies = []
+    sleep = opts.callback_sleep
+
+    def _callback(payload):
+        now = time.time()
+        for sent in (payload if create == 'create_batch_consumer' else [payload]):
+            latencies.append(now - sent)
+        if sleep:
+            eventlet.sleep(sleep)
+    getattr(conn, create)(topic, _callback, **kwargs)
+    conn.consume_in_thread()
+    eventlet.sleep(0.01)
+    start = time.time()
+    for i in range(opts.count):
+        conn.publish(topic, time.time())
+        if i % 100 == 0:
+            eventlet.sleep(0)
+    wait_for(lambda: len(latencies) >= opts.count, opts.timeout)
+    elapsed = time.time() - start
+    conn.shutdown()
+    result = {'received': len(latencies), 'msgs_per_sec': len(latencies) / elapsed}
+    result.update(('latency_' + k, v) for k, v in percentiles(latencies).items())
+    return result
+
+
+def bench_consume(opts):
+    """Consume throughput and latency for the ack modes, dispatch modes and
+    a batch consumer."""
+    results = {'ack_single': _consume(opts, ack_mode='single'),
+               'ack_batch': _consume(opts, ack_mode='batch'),
+               'batch_consumer_100': _consume(opts, 'create_batch_consumer', max_batch=100, max_wait_ms=10)}
+    for size in opts.pool_sizes:
+        results['dispatch_pool_%d' % size] = _consume(opts, dispatch='pool', pool_size=size)
+    return results
+
+
+def bench_pool(opts):
+    """Checkout and publish through ConnectionContext from concurrent
+    greenthreads, for several pool sizes."""
+    results = {}
+    per_thread = max(opts.count // 10, 1)
+    for size in opts.pool_sizes:
+        conf = make_conf(opts.url, pool_size=size)
+        pool = impl_rabbitmq.Pool(conf, impl_rabbitmq.Connection)
+        topic = 'bench.pool.%s' % uuid.uuid4().hex
+
+        def _publisher():
+            for i in range(per_thread):
+                context = impl_rabbitmq.ConnectionContext(conf, pool)
+                context.publish(topic, i)
+                context.close()
+        start = time.time()
+        threads = [eventlet.spawn(_publisher) for _ in range(10)]
+        for thread in threads:
+            thread.wait()
+        elapsed = time.time() - start
+        stats = pool.stats()
+        results['pool_%d' % size] = {'msgs_per_sec': per_thread * 10 / elapsed,
+                                     'avg_checkout_wait': stats['avg_wait_time'],
+                                     'max_checkout_wait': stats['max_wait_time'],
+                                     'creates': stats['creates']}
+        while pool.free_items:
+            pool.free_items.popleft().close()
+    return results
+
+
+def _per_call(func, count):
+    start = time.time()
+    for _ in xrange(count):
+        func()
+    return (time.time() - start) / count * 1e9
+
+
+def bench_config(opts):
+    """Nanoseconds per ConfigOpts.get hit and miss, snapshot attribute load
+    and register_opts of a typical option list."""
+    conf = make_conf('memory://', pool_size=16, ack_mode='batch', codecs='a:json,b:raw')
+    option_list = [IntOpt('pool_size', 'rabbitmq'), StrOpt('ack_mode', 'rabbitmq'),
+                   DictOpt('codecs', 'rabbitmq'), BoolOpt('publish_confirm', 'rabbitmq'),
+                   FloatOpt('ack_interval', 'rabbitmq'), ListOpt('hosts', 'rabbitmq')]
+    conf.register_opts(option_list)
+    snapshot = conf.snapshot()
+    return {'get_ns': _per_call(lambda: conf.get('pool_size', 'rabbitmq'), opts.count * 10),
+            'get_default_ns': _per_call(lambda: conf.get('absent', 'rabbitmq', default=1), opts.count * 10),
+            'group_item_ns': _per_call(lambda: conf['rabbitmq']['ack_mode'], opts.count * 10),
+            'snapshot_attr_ns': _per_call(lambda: snapshot.rabbitmq.pool_size, opts.count * 10),
+            'register_opts_ns': _per_call(lambda: conf.register_opts(option_list), opts.count // 10 or 1),
+            'freeze_ns': _per_call(conf.freeze, opts.count // 100 or 1)}
+
+
+class FsyncFileHandler(logging.FileHandler):
+    """A durable sink: every flush waits for the disk."""
+    def flush(self):
+        logging.FileHandler.flush(self)
+        if self.stream is not None:
+            os.fsync(self.stream.fileno())
+
+
+def bench_log(opts):
+    """Nanoseconds per logger.info call, synchronous and asynchronous
+    handlers writing to a temporary file, without the caller lookup and
+    sampled 1 in 10; then both handlers again on a file synced on every
+    flush, where the writer thread pays the disk waits."""
+    results = {}
+    directory = tempfile.mkdtemp()
+    modes = [('sync', {}), ('async', {}), ('no_caller', {'caller_info': False}), ('sampled', {'sample': 10}),
+             ('sync_fsync', {}), ('async_fsync', {})]
+    try:
+        for mode, options in modes:
+            logger_conf = {'handlers': ['files'], 'level': 'INFO', 'propagate': False}
+            logger_conf.update(options)
+            handler_cls = '__main__.FsyncFileHandler' if mode.endswith('_fsync') else 'logging.FileHandler'
+            config = {'async': {'enabled': mode.startswith('async'), 'queue_size': opts.count + 1},
+                      'formatters': {'standard': {'format': "%(asctime)s [%(threadName)s:%(thread)d] "
+                                                  "[%(filename)s:%(lineno)d] [%(levelname)s]- %(message)s"}},
+                      'handlers': {'files': {'level': 'INFO', 'class': handler_cls,
+                                             'filename': os.path.join(directory, 'x.log'),
+                                             'per_logger': True, 'formatter': 'standard'}},
+                      'loggers': {'bench.%s' % mode: logger_conf}}
+            path = os.path.join(directory, '%s.json' % mode)
+            with open(path, 'w') as fp:
+                json.dump(config, fp)
+            log.setup(path)
+            logger = log.getLogger('bench.%s' % mode)
+            start = time.time()
+            for i in xrange(opts.count):
+                logger.info("message %d of %s", i, mode)
+            call = time.time() - start
+            if mode.startswith('async'):
+                log.get_writer().flush()
+            results[mode] = {'call_ns': call / opts.count * 1e9,
+                             'written_ns': (time.time() - start) / opts.count * 1e9}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+SCENARIOS = [('publish', bench_publish), ('consume', bench_consume), ('pool', bench_pool),
+             ('config', bench_config), ('log', bench_log)]
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [scenario ...]",
+                                   description="scenarios: " + ", ".join(name for name, _ in SCENARIOS))
+    parser.add_option('-n', '--count', type='int', default=10000, help="messages or calls per measure")
+    parser.add_option('-u', '--url', default='memory://', help="broker url, memory:// by default")
+    parser.add_option('-p', '--pool-sizes', default='1,10,50', help="pool and dispatch sizes")
+    parser.add_option('-s', '--callback-sleep', type='float', default=0.0,
+                      help="seconds the consume callback sleeps, to simulate I/O")
+    parser.add_option('-t', '--timeout', type='float', default=60, help="seconds to wait for the consumers")
+    parser.add_option('-o', '--output', help="write the JSON there instead of stdout")
+    opts, names = parser.parse_args()
+    opts.pool_sizes = [int(size) for size in opts.pool_sizes.split(',')]
+    unknown = set(names) - set(name for name, _ in SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: %s" % ", ".join(sorted(unknown)))
+    report = {'version': version(), 'python': platform.python_version(), 'time': time.time(),
+              'url': opts.url, 'count': opts.count, 'results': {}}
+    for name, func in SCENARIOS:
+        if not names or name in names:
+            report['results'][name] = func(opts)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == "__main__":
+    main()